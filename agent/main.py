@@ -4,14 +4,35 @@ Executes allowed actions on FM/Docker stacks
 """
 import os
 import re
-import subprocess
+import base64
+import fnmatch
+import stat
+import shutil
+import hashlib
+import gzip
+import zlib
+import errno
+import fcntl
+import sqlite3
+import tempfile
+import threading
+import json
+import time
+import asyncio
 import logging
+import uuid
+import mimetypes
+from email.utils import formatdate
+from collections import OrderedDict, deque
+from contextvars import ContextVar
 from pathlib import Path
 from datetime import datetime
-from typing import Dict, List, Optional
+from typing import AsyncIterator, Awaitable, Callable, Dict, Iterator, List, Optional
 import yaml
-from fastapi import FastAPI, HTTPException, Depends, Header
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, HTTPException, Depends, Header, Request
+from fastapi.responses import Response, StreamingResponse
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
 
 # Configure logging
@@ -49,6 +70,76 @@ AGENT_CONFIG = config["agent"]
 SECURITY_CONFIG = config["security"]
 STACKS_CONFIG = config["stacks"]
 BACKUPS_CONFIG = config["backups"]
+EXECUTION_CONFIG = config.get("execution") or {}
+CACHE_CONFIG = config.get("cache") or {}
+JOBS_CONFIG = config.get("jobs") or {}
+
+# Command execution limits
+COMMAND_TIMEOUT = EXECUTION_CONFIG.get("command_timeout", 300)
+MAX_CONCURRENT_COMMANDS = EXECUTION_CONFIG.get("max_concurrent_commands", 16)
+MAX_CONCURRENT_PER_STACK = EXECUTION_CONFIG.get("max_concurrent_per_stack", 4)
+# Read-only commands (fm list/status/logs, docker ps) have their own lane, so
+# long mutations never hold up status reads
+MAX_CONCURRENT_READS = EXECUTION_CONFIG.get("max_concurrent_reads", 8)
+MAX_CONCURRENT_READS_PER_STACK = EXECUTION_CONFIG.get("max_concurrent_reads_per_stack", 2)
+STATUS_WORKERS = EXECUTION_CONFIG.get("status_workers", 8)
+STATUS_DEADLINE = EXECUTION_CONFIG.get("status_deadline", 20)
+INVENTORY_TTL = EXECUTION_CONFIG.get("inventory_ttl", 5)
+SITE_INDEX_POLL_INTERVAL = EXECUTION_CONFIG.get("site_index_poll_interval", 10)
+MAX_LOG_STREAMS = EXECUTION_CONFIG.get("max_log_streams", 8)
+# restart_stack: "parallel" restarts benches at once (up to restart_concurrency),
+# "rolling" restarts rolling_batch benches at a time, waiting until they are healthy
+RESTART_MODE = EXECUTION_CONFIG.get("restart_mode", "parallel")
+RESTART_CONCURRENCY = EXECUTION_CONFIG.get("restart_concurrency", max(1, MAX_CONCURRENT_PER_STACK - 1))
+ROLLING_BATCH = EXECUTION_CONFIG.get("rolling_batch", 1)
+HEALTH_TIMEOUT = EXECUTION_CONFIG.get("health_timeout", 300)
+# update_stack: compose projects pulling images at once, and the pull timeout
+PULL_CONCURRENCY = EXECUTION_CONFIG.get("pull_concurrency", max(1, MAX_CONCURRENT_PER_STACK - 1))
+PULL_TIMEOUT = EXECUTION_CONFIG.get("pull_timeout", 1800)
+# Sites migrate_stack migrates at once (unless the request asks for fewer), and per bench
+MIGRATE_CONCURRENCY = EXECUTION_CONFIG.get("migrate_concurrency", max(1, MAX_CONCURRENT_PER_STACK - 1))
+MIGRATE_PER_BENCH = EXECUTION_CONFIG.get("migrate_per_bench", 2)
+
+# fm list / fm status caching
+CACHE_TTL = CACHE_CONFIG.get("ttl", 15)
+CACHE_MAX_STALE = CACHE_CONFIG.get("max_stale", 300)
+DIR_SIZE_TTL = CACHE_CONFIG.get("dir_size_ttl", 300)
+
+# Background jobs
+JOB_WORKERS = JOBS_CONFIG.get("workers", 4)
+JOB_HISTORY = JOBS_CONFIG.get("history", 200)
+JOB_OUTPUT_LINES = JOBS_CONFIG.get("output_lines", 500)
+# Items of one POST /actions/batch started at once (they still queue for job workers)
+BATCH_CONCURRENCY = JOBS_CONFIG.get("batch_concurrency", JOB_WORKERS)
+
+# Backup catalog (SQLite), kept next to the backups unless configured
+BACKUP_CATALOG_PATH = BACKUPS_CONFIG.get("catalog_path") or str(
+    Path(BACKUPS_CONFIG["base_path"]) / ".catalog.sqlite3"
+)
+# What happens to bench's own copy of a backup once it is ingested: "keep" or "remove"
+BACKUP_SOURCE_CLEANUP = BACKUPS_CONFIG.get("source_cleanup", "keep")
+# Retention: rules default to backups.retention_days, overridable per stack/site
+RETENTION_CONFIG = BACKUPS_CONFIG.get("retention") or {}
+PRUNE_INTERVAL = RETENTION_CONFIG.get("prune_interval", 3600)
+PRUNE_BATCH = RETENTION_CONFIG.get("batch_size", 100)
+# "files" keeps each backup as a standalone .sql.gz, "dedup" as chunks shared between backups
+BACKUP_STORAGE = BACKUPS_CONFIG.get("storage", "files")
+# Also back up public/private files (bench backup --with-files)
+BACKUP_WITH_FILES = BACKUPS_CONFIG.get("with_files", False)
+# Site backups of backup_stack running at once, host-wide and per bench
+BACKUP_MAX_CONCURRENT = BACKUPS_CONFIG.get("max_concurrent", max(1, MAX_CONCURRENT_PER_STACK - 1))
+BACKUP_MAX_PER_BENCH = BACKUPS_CONFIG.get("max_concurrent_per_bench", 2)
+
+# Actions that change stack/site state and invalidate cached status
+MUTATING_ACTIONS = {"restart_stack", "restart_site", "migrate_site", "migrate_stack", "update_stack"}
+# Long-running actions that POST /action submits to the job queue
+JOB_ACTIONS = MUTATING_ACTIONS | {"backup_site", "backup_stack"}
+# Actions that operate on a single site
+SITE_ACTIONS = {"restart_site", "migrate_site", "backup_site"}
+# Actions taking params.concurrency (how many sites or benches run at once)
+CONCURRENCY_ACTIONS = {"migrate_stack", "restart_stack", "update_stack"}
+# Actions taking params.mode (see run_bench_tasks)
+BENCH_MODE_ACTIONS = {"restart_stack", "update_stack"}
 
 # Initialize FastAPI
 app = FastAPI(title="FM Agent Service", version="1.0.0")
@@ -79,12 +170,32 @@ class ActionRequest(BaseModel):
     params: Optional[Dict] = {}
 
 
+class BatchActionItem(ActionRequest):
+    id: Optional[str] = None
+    after: List[str] = []
+
+
+class BatchActionRequest(BaseModel):
+    actions: List[BatchActionItem]
+    stop_on_failure: bool = False
+
+
 class ActionResponse(BaseModel):
     success: bool
     message: str
     data: Optional[Dict] = None
 
 
+class FilePatchOp(BaseModel):
+    offset: int
+    delete: int = 0
+    insert: str = ""
+
+
+class FilePatchRequest(BaseModel):
+    ops: List[FilePatchOp]
+
+
 class StackInfo(BaseModel):
     name: str
     path: str
@@ -93,29 +204,299 @@ class StackInfo(BaseModel):
     containers: List[Dict] = []
 
 
-# Helper Functions
-def run_command(cmd: List[str], cwd: Optional[str] = None) -> tuple:
+# Command Execution Engine
+_command_semaphore: Optional[asyncio.Semaphore] = None
+_stack_semaphores: Dict[str, asyncio.Semaphore] = {}
+_read_semaphore: Optional[asyncio.Semaphore] = None
+_stack_read_semaphores: Dict[str, asyncio.Semaphore] = {}
+# Limits of stack-wide actions, keyed (action kind,) host-wide or (kind, stack, bench)
+_pool_semaphores: Dict[tuple, asyncio.Semaphore] = {}
+# Open log followers (see stream_logs)
+_log_streams = {"active": 0}
+# Job whose transcript commands run by the current task are captured into
+_current_job: ContextVar[Optional[Dict]] = ContextVar("current_job", default=None)
+# Per-site transcript of a stack-wide action (see run_site_tasks)
+_site_output: ContextVar[Optional[deque]] = ContextVar("site_output", default=None)
+
+
+def get_command_semaphore() -> asyncio.Semaphore:
+    """Host-wide limit on concurrently running commands"""
+    global _command_semaphore
+    if _command_semaphore is None:
+        _command_semaphore = asyncio.Semaphore(MAX_CONCURRENT_COMMANDS)
+    return _command_semaphore
+
+
+def stack_command_limit(stack_name: str) -> int:
+    """Commands allowed to run at once on a stack (`max_concurrent` in the stacks section overrides)"""
+    return (STACKS_CONFIG.get(stack_name) or {}).get("max_concurrent", MAX_CONCURRENT_PER_STACK)
+
+
+def stack_fanout_limit(stack_name: str) -> int:
+    """
+    Commands one stack-wide action may run at once on a stack: one less than
+    the stack's limit, so single-site actions still get a slot
+    """
+    return max(1, stack_command_limit(stack_name) - 1)
+
+
+def get_stack_semaphore(stack_name: str) -> asyncio.Semaphore:
+    """Per-stack limit on concurrently running commands
+    
+    Can be overridden per stack with `max_concurrent` in the stacks section.
+    """
+    if stack_name not in _stack_semaphores:
+        _stack_semaphores[stack_name] = asyncio.Semaphore(stack_command_limit(stack_name))
+    return _stack_semaphores[stack_name]
+
+
+def get_read_semaphore(stack_name: Optional[str] = None) -> asyncio.Semaphore:
+    """Limit on concurrently running read-only commands, host-wide or for a stack"""
+    global _read_semaphore
+    if stack_name is None:
+        if _read_semaphore is None:
+            _read_semaphore = asyncio.Semaphore(MAX_CONCURRENT_READS)
+        return _read_semaphore
+    if stack_name not in _stack_read_semaphores:
+        _stack_read_semaphores[stack_name] = asyncio.Semaphore(MAX_CONCURRENT_READS_PER_STACK)
+    return _stack_read_semaphores[stack_name]
+
+
+def get_pool_semaphore(key: tuple, limit: int) -> asyncio.Semaphore:
+    """Limit on how many sites a stack-wide action works on at once (see run_site_tasks)"""
+    if key not in _pool_semaphores:
+        _pool_semaphores[key] = asyncio.Semaphore(limit)
+    return _pool_semaphores[key]
+
+
+# Check the command limits once at load. Stack-wide actions are capped at one
+# command less than a stack's limit (stack_fanout_limit); say so if the
+# configuration asks for more
+for _stack in STACKS_CONFIG:
+    if stack_command_limit(_stack) < 1:
+        raise ValueError(f"max_concurrent of stack '{_stack}' must be at least 1")
+for _setting, _value in (("execution.restart_concurrency", RESTART_CONCURRENCY),
+                         ("execution.pull_concurrency", PULL_CONCURRENCY),
+                         ("execution.migrate_concurrency", MIGRATE_CONCURRENCY),
+                         ("backups.max_concurrent", BACKUP_MAX_CONCURRENT)):
+    for _stack in STACKS_CONFIG:
+        if _value > stack_fanout_limit(_stack):
+            logger.warning(f"{_setting} ({_value}) leaves no command slot free on stack '{_stack}' "
+                           f"(limit {stack_command_limit(_stack)}); it runs at most "
+                           f"{stack_fanout_limit(_stack)} at once there")
+
+
+async def _pump_stream(stream: asyncio.StreamReader, name: str, chunks: List[str],
+                       on_output: Optional[Callable[[str, str], None]] = None):
+    """Read a process stream incrementally, forwarding complete lines to on_output"""
+    pending = ""
+    while True:
+        data = await stream.read(65536)
+        if not data:
+            break
+        text = data.decode(errors="replace")
+        chunks.append(text)
+        if on_output:
+            pending += text
+            *lines, pending = pending.split("\n")
+            for line in lines:
+                on_output(name, line)
+    if on_output and pending:
+        on_output(name, pending)
+
+
+async def run_command(
+    cmd: List[str],
+    cwd: Optional[str] = None,
+    stack: Optional[str] = None,
+    timeout: Optional[float] = None,
+    on_output: Optional[Callable[[str, str], None]] = None,
+    read_only: bool = False
+) -> tuple:
     """
     Execute command safely without shell=True
+    
+    Runs under the host-wide semaphore and, when a stack is given, that
+    stack's semaphore; read_only commands use the separate read semaphores
+    instead. stdout/stderr are read as they are produced and
+    passed line by line to on_output(stream_name, line) if provided.
+    Inside a job, the command and its output are added to the job's transcript
+    (and to the site's own transcript within a stack-wide action), unless it
+    is read_only: lookups such as docker ps are not what the job did.
     Returns (success, output, error)
     """
+    timeout = timeout or COMMAND_TIMEOUT
+    if read_only:
+        stack_semaphore = get_read_semaphore(stack) if stack else None
+        host_semaphore = get_read_semaphore()
+    else:
+        stack_semaphore = get_stack_semaphore(stack) if stack else None
+        host_semaphore = get_command_semaphore()
+    job = None if read_only else _current_job.get()
+    site_output = None if read_only else _site_output.get()
+    transcripts = [lines for lines in (job["output"] if job else None, site_output) if lines is not None]
+    for lines in transcripts:
+        on_output = _output_sink(lines, on_output)
     try:
-        logger.info(f"Executing command: {' '.join(cmd)} in {cwd or 'current dir'}")
-        result = subprocess.run(
-            cmd,
-            cwd=cwd,
-            capture_output=True,
-            text=True,
-            timeout=300
-        )
-        success = result.returncode == 0
-        return success, result.stdout, result.stderr
-    except subprocess.TimeoutExpired:
-        return False, "", "Command timed out"
+        # Wait for the stack slot first so a busy stack doesn't hold host slots
+        if stack_semaphore:
+            await stack_semaphore.acquire()
+        try:
+            async with host_semaphore:
+                for lines in transcripts:
+                    lines.append(f"$ {' '.join(cmd)}")
+                success, output, error, returncode = await _execute(cmd, cwd, timeout, on_output)
+                if job is not None and returncode:
+                    job["exit_code"] = returncode
+                return success, output, error
+        finally:
+            if stack_semaphore:
+                stack_semaphore.release()
     except Exception as e:
         return False, "", str(e)
 
 
+async def _execute(cmd: List[str], cwd: Optional[str], timeout: float,
+                   on_output: Optional[Callable[[str, str], None]]) -> tuple:
+    """Spawn the process and collect its output
+    Returns (success, output, error, returncode)
+    """
+    logger.info(f"Executing command: {' '.join(cmd)} in {cwd or 'current dir'}")
+    process = await asyncio.create_subprocess_exec(
+        *cmd,
+        cwd=cwd,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    stdout, stderr = [], []
+    readers = asyncio.gather(
+        _pump_stream(process.stdout, "stdout", stdout, on_output),
+        _pump_stream(process.stderr, "stderr", stderr, on_output),
+        process.wait()
+    )
+    # Retrieve the outcome even when we are cancelled, so it is never reported as lost
+    readers.add_done_callback(lambda f: f.cancelled() or f.exception())
+    try:
+        await asyncio.wait_for(readers, timeout=timeout)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        return False, "".join(stdout), "Command timed out", process.returncode
+    finally:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+    
+    success = process.returncode == 0
+    return success, "".join(stdout), "".join(stderr), process.returncode
+
+
+async def stream_command(cmd: List[str], cwd: Optional[str] = None,
+                         heartbeat: Optional[float] = None) -> AsyncIterator[Optional[str]]:
+    """
+    Run a long-lived command and yield its output (stdout and stderr) line by line
+    
+    Yields None after `heartbeat` seconds without output. The process is
+    killed when the consumer stops iterating. Not subject to the command
+    semaphores, since followers never finish; callers bound them separately.
+    """
+    logger.info(f"Streaming command: {' '.join(cmd)} in {cwd or 'current dir'}")
+    process = await asyncio.create_subprocess_exec(
+        *cmd,
+        cwd=cwd,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT,
+        limit=1024 * 1024
+    )
+    try:
+        while True:
+            try:
+                line = await asyncio.wait_for(process.stdout.readline(), timeout=heartbeat)
+            except asyncio.TimeoutError:
+                yield None
+                continue
+            if not line:
+                break
+            yield line.decode(errors="replace").rstrip("\r\n")
+    finally:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+
+
+# Snapshot Cache
+# Results of read-only commands (fm list, fm status) served for CACHE_TTL seconds,
+# then served stale for up to CACHE_MAX_STALE while one background refresh runs
+_snapshots: Dict[tuple, Dict] = {}
+
+
+def _start_refresh(key: tuple, loader: Callable[[], Awaitable]) -> asyncio.Task:
+    """Start the single refresh for a key"""
+    entry = _snapshots.setdefault(key, {"value": None, "fetched_at": None, "generation": 0, "refresh": None})
+    entry["refresh"] = asyncio.create_task(_refresh_snapshot(entry, loader))
+    return entry["refresh"]
+
+
+async def _refresh_snapshot(entry: Dict, loader: Callable[[], Awaitable]):
+    """Run a loader and store its result, unless the key was invalidated meanwhile"""
+    # The task copied the context of whoever started it; a shared refresh
+    # belongs to no job
+    _current_job.set(None)
+    _site_output.set(None)
+    generation = entry["generation"]
+    try:
+        value = await loader()
+        if entry["generation"] == generation:
+            entry["value"] = value
+            entry["fetched_at"] = time.monotonic()
+        return value
+    finally:
+        # An invalidation may have detached this refresh and started another
+        if entry["refresh"] is asyncio.current_task():
+            entry["refresh"] = None
+
+
+async def cached_snapshot(key: tuple, loader: Callable[[], Awaitable]) -> tuple:
+    """
+    Get a cached result, loading it if missing or too stale
+    Returns (value, age_in_seconds)
+    """
+    entry = _snapshots.get(key)
+    if entry and entry["fetched_at"] is not None:
+        age = time.monotonic() - entry["fetched_at"]
+        if age <= CACHE_TTL:
+            return entry["value"], age
+        if age <= CACHE_MAX_STALE:
+            if entry["refresh"] is None:
+                _start_refresh(key, loader).add_done_callback(_log_refresh_failure)
+            return entry["value"], age
+    
+    # Nothing usable: wait for a load, sharing one already in flight
+    task = entry["refresh"] if entry and entry["refresh"] else _start_refresh(key, loader)
+    return await asyncio.shield(task), 0.0
+
+
+def _log_refresh_failure(task: asyncio.Task):
+    """Background refreshes keep serving stale data on failure"""
+    if not task.cancelled() and task.exception():
+        logger.error(f"Background refresh failed: {task.exception()}")
+
+
+def invalidate_stack_snapshots(stack_name: str):
+    """Drop cached results for a stack after it was changed"""
+    for key, entry in _snapshots.items():
+        if key[1] == stack_name:
+            entry["generation"] += 1
+            entry["fetched_at"] = None
+            entry["value"] = None
+            # A refresh in flight started before the change: later callers
+            # must start their own load instead of waiting for its result
+            entry["refresh"] = None
+
+
+# Helper Functions
 def get_stack_path(stack_name: str) -> Path:
     """Get and validate stack path"""
     if stack_name not in STACKS_CONFIG:
@@ -136,6 +517,223 @@ def get_backup_path(stack_name: str, site_name: str) -> Path:
     return backup_dir
 
 
+# Container Inventory
+# One `docker ps -a` per refresh answers every container question for all stacks
+_inventory: Dict = {"containers": [], "fetched_at": 0.0}
+_inventory_lock: Optional[asyncio.Lock] = None
+
+
+def _parse_labels(labels: str) -> Dict[str, str]:
+    """Parse docker's "key=value,key=value" label string"""
+    parsed = {}
+    last_key = None
+    for part in (labels or "").split(","):
+        if "=" in part:
+            key, value = part.split("=", 1)
+            parsed[key] = value
+            last_key = key
+        elif last_key:
+            # Values such as config_files may themselves contain commas
+            parsed[last_key] += f",{part}"
+    return parsed
+
+
+def _normalize_container(raw: Dict) -> Dict:
+    """Shape a `docker ps` record like a `docker-compose ps` one"""
+    labels = _parse_labels(raw.get("Labels", ""))
+    status = raw.get("Status", "")
+    health = None
+    for marker in ("healthy", "unhealthy", "health: starting"):
+        if f"({marker})" in status:
+            health = marker.replace("health: ", "")
+            break
+    return {
+        "ID": raw.get("ID", ""),
+        "Name": raw.get("Names", ""),
+        "Image": raw.get("Image", ""),
+        "State": raw.get("State", ""),
+        "Status": status,
+        "Health": health,
+        "Project": labels.get("com.docker.compose.project", ""),
+        "Service": labels.get("com.docker.compose.service", ""),
+        "WorkingDir": labels.get("com.docker.compose.project.working_dir", "")
+    }
+
+
+async def get_container_inventory(max_age: float = INVENTORY_TTL) -> List[Dict]:
+    """Get all containers on the host, refreshing the snapshot if older than max_age"""
+    global _inventory_lock
+    if _inventory_lock is None:
+        _inventory_lock = asyncio.Lock()
+    
+    async with _inventory_lock:
+        # Concurrent callers wait here and reuse the snapshot the first one fetched
+        if time.monotonic() - _inventory["fetched_at"] <= max_age:
+            return _inventory["containers"]
+        
+        success, output, error = await run_command(
+            ["docker", "ps", "-a", "--no-trunc", "--format", "{{json .}}"],
+            timeout=30,
+            read_only=True
+        )
+        if not success:
+            logger.error(f"Failed to list containers: {error}")
+            return _inventory["containers"]
+        
+        containers = []
+        for line in output.strip().split("\n"):
+            if not line:
+                continue
+            try:
+                containers.append(_normalize_container(json.loads(line)))
+            except ValueError as e:
+                logger.debug(f"Error parsing docker ps line: {e}")
+        
+        _inventory["containers"] = containers
+        _inventory["fetched_at"] = time.monotonic()
+        return containers
+
+
+def invalidate_container_inventory():
+    """Force the next inventory lookup to query docker again"""
+    _inventory["fetched_at"] = 0.0
+
+
+def _compose_project_name(directory: Path) -> str:
+    """Default compose project name for a directory"""
+    return re.sub(r"[^a-z0-9_-]", "", directory.name.lower())
+
+
+def _same_or_under(working_dir: str, path: Path) -> bool:
+    """Check whether a compose working dir is path or inside it"""
+    if not working_dir:
+        return False
+    candidates = {str(path), str(path.resolve())}
+    return any(working_dir == p or working_dir.startswith(p.rstrip("/") + "/") for p in candidates)
+
+
+def stack_containers(containers: List[Dict], stack_path: Path) -> List[Dict]:
+    """Containers of every compose project under a stack (root and benches)"""
+    return [c for c in containers if _same_or_under(c["WorkingDir"], stack_path)]
+
+
+def bench_containers(containers: List[Dict], bench_path: Path) -> List[Dict]:
+    """Containers of the compose project living in a bench directory"""
+    paths = {str(bench_path), str(bench_path.resolve())}
+    matched = [c for c in containers if c["WorkingDir"] in paths]
+    if matched:
+        return matched
+    # Containers created without working_dir labels: match on project name
+    project = _compose_project_name(bench_path)
+    return [c for c in containers if c["Project"] == project]
+
+
+def find_service_container(containers: List[Dict], bench_path: Path, service: str) -> Optional[Dict]:
+    """Find a compose service's container in a bench, preferring running ones"""
+    matches = [c for c in bench_containers(containers, bench_path) if c["Service"] == service]
+    matches.sort(key=lambda c: c["State"] != "running")
+    return matches[0] if matches else None
+
+
+# Site Index
+# stacks -> benches -> sites, kept current by polling directory mtimes
+# (adding or removing a site or bench changes its parent directory's mtime)
+NON_SITE_DIRS = {"assets", "apps", "common_site_config.json"}
+_site_index: Dict[str, Dict] = {}
+_site_index_updated: Optional[datetime] = None
+
+
+def _dir_mtime(path: Path) -> Optional[int]:
+    """mtime of a directory, or None if it is missing"""
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _scan_bench_sites(bench_dir: Path) -> List[str]:
+    """Names of the sites inside a bench's frappe-bench/sites directory"""
+    sites = []
+    try:
+        with os.scandir(bench_dir / "workspace" / "frappe-bench" / "sites") as entries:
+            for entry in entries:
+                if entry.is_dir() and entry.name not in NON_SITE_DIRS:
+                    sites.append(entry.name)
+    except OSError:
+        pass
+    return sorted(sites)
+
+
+def refresh_stack_index(stack_name: str) -> bool:
+    """Rescan the parts of a stack whose directories changed
+    
+    Costs one stat per bench when nothing changed. Returns True if the
+    stack's entry was updated.
+    """
+    global _site_index_updated
+    sites_dir = Path(STACKS_CONFIG[stack_name]["path"]) / "sites"
+    previous = _site_index.get(stack_name, {"mtime": None, "benches": {}})
+    mtime = _dir_mtime(sites_dir)
+    
+    if mtime is None:
+        bench_dirs = []
+    elif mtime != previous["mtime"]:
+        with os.scandir(sites_dir) as entries:
+            bench_dirs = sorted(Path(e.path) for e in entries if e.is_dir())
+    else:
+        bench_dirs = [Path(b["path"]) for b in previous["benches"].values()]
+    
+    changed = stack_name not in _site_index or mtime != previous["mtime"]
+    benches = {}
+    for bench_dir in bench_dirs:
+        old = previous["benches"].get(bench_dir.name)
+        sites_mtime = _dir_mtime(bench_dir / "workspace" / "frappe-bench" / "sites")
+        if old and old["mtime"] == sites_mtime:
+            benches[bench_dir.name] = old
+            continue
+        changed = True
+        benches[bench_dir.name] = {
+            "path": str(bench_dir),
+            "mtime": sites_mtime,
+            "sites": _scan_bench_sites(bench_dir) if sites_mtime is not None else []
+        }
+    
+    if changed:
+        # Replace the entry in one assignment so readers never see a partial stack
+        _site_index[stack_name] = {
+            "mtime": mtime,
+            "benches": benches,
+            "sites": {site: name for name, bench in benches.items() for site in bench["sites"]}
+        }
+        _site_index_updated = datetime.now()
+        logger.info(f"Indexed stack '{stack_name}': {len(benches)} benches, "
+                    f"{len(_site_index[stack_name]['sites'])} sites")
+    return changed
+
+
+def refresh_site_index():
+    """Refresh the index for every configured stack"""
+    for stack_name in STACKS_CONFIG:
+        try:
+            refresh_stack_index(stack_name)
+        except Exception as e:
+            logger.error(f"Error indexing stack {stack_name}: {e}")
+
+
+def get_stack_index(stack_name: str) -> Dict:
+    """Indexed benches and sites of a stack, building the entry on first use"""
+    if stack_name not in _site_index:
+        refresh_stack_index(stack_name)
+    return _site_index[stack_name]
+
+
+async def poll_site_index():
+    """Background task keeping the site index current"""
+    while True:
+        await asyncio.sleep(SITE_INDEX_POLL_INTERVAL)
+        await run_in_threadpool(refresh_site_index)
+
+
 # Agent Actions
 def find_site_bench(stack_name: str, site_name: str) -> Path:
     """Find the bench directory that contains a specific site
@@ -146,16 +744,14 @@ def find_site_bench(stack_name: str, site_name: str) -> Path:
     stack_path = get_stack_path(stack_name)
     sites_dir = stack_path / "sites"
     
-    if sites_dir.exists() and sites_dir.is_dir():
-        for bench_dir in sites_dir.iterdir():
-            if not bench_dir.is_dir():
-                continue
-            
-            # Check if site exists in this bench
-            site_path = bench_dir / "workspace" / "frappe-bench" / "sites" / site_name
-            if site_path.exists() and site_path.is_dir():
-                logger.info(f"Found site '{site_name}' in bench '{bench_dir.name}'")
-                return bench_dir
+    index = get_stack_index(stack_name)
+    if site_name not in index["sites"] and refresh_stack_index(stack_name):
+        # Created since the last poll
+        index = _site_index[stack_name]
+    
+    bench_name = index["sites"].get(site_name)
+    if bench_name:
+        return Path(index["benches"][bench_name]["path"])
     
     # If not found in FM structure, assume site name is also bench name (fallback)
     fallback = sites_dir / site_name
@@ -165,63 +761,29 @@ def find_site_bench(stack_name: str, site_name: str) -> Path:
     raise FileNotFoundError(f"Site '{site_name}' not found in stack '{stack_name}'")
 
 
-def get_backend_container_name(bench_path: Path) -> str:
+async def get_backend_container_name(bench_path: Path) -> str:
     """Get the actual backend container name for a bench
     
     In FM, containers are named based on the bench/project name.
-    We need to find the actual container name dynamically.
+    We look the backend service up in the host container inventory.
     """
-    # Try to get container name from docker-compose ps
-    success, output, error = run_command(
-        ["docker-compose", "ps", "-q", "backend"],
-        cwd=bench_path
-    )
-    
-    if success and output.strip():
-        # Get container ID
-        container_id = output.strip().split('\n')[0]
-        
-        # Get container name from ID
-        success2, output2, error2 = run_command(
-            ["docker", "inspect", "--format", "{{.Name}}", container_id]
-        )
-        
-        if success2 and output2.strip():
-            # Remove leading / from container name
-            container_name = output2.strip().lstrip('/')
-            logger.info(f"Found backend container: {container_name}")
-            return container_name
-    
-    # Fallback: try common naming patterns
-    bench_name = bench_path.name
-    possible_names = [
-        f"{bench_name}-backend-1",
-        f"{bench_name}_backend_1",
-        f"{bench_name.replace('.', '-')}-backend-1",
-        f"{bench_name.replace('.', '_')}_backend_1",
-        "backend"  # Last resort
-    ]
-    
-    for name in possible_names:
-        # Check if container exists
-        success, output, error = run_command(
-            ["docker", "inspect", name]
-        )
-        if success:
-            logger.info(f"Found backend container using fallback: {name}")
-            return name
+    containers = await get_container_inventory()
+    container = find_service_container(containers, bench_path, "backend")
+    if container:
+        logger.info(f"Found backend container: {container['Name']}")
+        return container["Name"]
     
     # Ultimate fallback
-    logger.warning(f"Could not find backend container for bench {bench_name}, using 'backend'")
+    logger.warning(f"Could not find backend container for bench {bench_path.name}, using 'backend'")
     return "backend"
 
 
-def list_sites(stack_name: str) -> List[Dict]:
-    """List all sites in a stack with their status using fm list"""
+async def _fm_list(stack_name: str) -> List[Dict]:
+    """Run fm list and parse its table"""
     stack_path = get_stack_path(stack_name)
     
     # Use fm list command to get sites with status
-    success, output, error = run_command(["fm", "list"], cwd=stack_path)
+    success, output, error = await run_command(["fm", "list"], cwd=stack_path, stack=stack_name, read_only=True)
     
     sites = []
     if success and output:
@@ -253,111 +815,231 @@ def list_sites(stack_name: str) -> List[Dict]:
                     logger.debug(f"Error parsing fm list line: {e}")
                     continue
     
-    # Fallback: scan directory structure if fm list fails
+    return sites
+
+
+async def list_sites_snapshot(stack_name: str) -> tuple:
+    """
+    List all sites in a stack with their status using (cached) fm list
+    Returns (sites, snapshot_age)
+    """
+    get_stack_path(stack_name)
+    sites, age = await cached_snapshot(("fm list", stack_name), lambda: _fm_list(stack_name))
+    sites = list(sites)
+    
+    # Fallback: use the site index if fm list fails
     if not sites:
-        sites_dir = stack_path / "sites"
-        if sites_dir.exists() and sites_dir.is_dir():
-            for bench_dir in sites_dir.iterdir():
-                if not bench_dir.is_dir():
-                    continue
-                
-                frappe_sites_dir = bench_dir / "workspace" / "frappe-bench" / "sites"
-                if frappe_sites_dir.exists() and frappe_sites_dir.is_dir():
-                    for site_dir in frappe_sites_dir.iterdir():
-                        if site_dir.is_dir() and site_dir.name not in ["assets", "common_site_config.json", "apps"]:
-                            sites.append({
-                                "name": site_dir.name,
-                                "status": "Unknown",
-                                "path": str(site_dir)
-                            })
+        for bench in get_stack_index(stack_name)["benches"].values():
+            for site_name in bench["sites"]:
+                sites.append({
+                    "name": site_name,
+                    "status": "Unknown",
+                    "path": str(Path(bench["path"]) / "workspace" / "frappe-bench" / "sites" / site_name)
+                })
     
+    return sites, age
+
+
+async def list_sites(stack_name: str) -> List[Dict]:
+    """List all sites in a stack with their status using fm list"""
+    sites, age = await list_sites_snapshot(stack_name)
     return sites
 
 
-def get_stack_status(stack_name: str) -> Dict:
+async def _fm_status(stack_name: str) -> bool:
+    """Run fm status, returning whether the stack is running"""
+    stack_path = get_stack_path(stack_name)
+    success, output, error = await run_command(["fm", "status"], cwd=stack_path, stack=stack_name, read_only=True)
+    return success
+
+
+async def get_stack_status(stack_name: str) -> Dict:
     """Get status of a stack and its containers"""
     stack_path = get_stack_path(stack_name)
     
-    # Get fm status
-    success, output, error = run_command(["fm", "status"], cwd=stack_path)
+    # Get (cached) fm status
+    running, age = await cached_snapshot(("fm status", stack_name), lambda: _fm_status(stack_name))
     
     status_info = {
         "name": stack_name,
         "path": str(stack_path),
         "type": STACKS_CONFIG[stack_name]["type"],
-        "status": "running" if success else "stopped",
-        "containers": []
+        "status": "running" if running else "stopped",
+        "containers": [],
+        "snapshot_age": round(age, 1)
     }
     
-    # Get docker containers
-    compose_file = stack_path / "docker-compose.yml"
-    if compose_file.exists():
-        success, output, error = run_command(
-            ["docker-compose", "ps", "--format", "json"],
-            cwd=stack_path
-        )
-        if success and output:
-            try:
-                import json
-                containers = [json.loads(line) for line in output.strip().split("\n") if line]
-                status_info["containers"] = containers
-            except:
-                pass
+    # Get docker containers for the stack and its benches
+    containers = await get_container_inventory()
+    status_info["containers"] = stack_containers(containers, stack_path)
     
     return status_info
 
 
-def restart_stack(stack_name: str) -> tuple:
-    """Restart an FM stack (all benches)"""
-    stack_path = get_stack_path(stack_name)
-    
-    # For FM, we restart all benches in the stack
-    sites_dir = stack_path / "sites"
+def stack_benches(stack_name: str) -> List[Path]:
+    """Bench directories (one compose project each) of a stack"""
+    sites_dir = get_stack_path(stack_name) / "sites"
     if not sites_dir.exists():
-        return False, "No benches found in stack"
-    
-    benches = [d for d in sites_dir.iterdir() if d.is_dir()]
-    if not benches:
-        return False, "No benches found in stack"
+        return []
+    return sorted(d for d in sites_dir.iterdir() if d.is_dir())
+
+
+async def restart_bench(stack_name: str, bench_dir: Path) -> Dict:
+    """Restart one bench with docker-compose down / up -d, timing it"""
+    started = time.monotonic()
+    result = {"bench": bench_dir.name, "success": False}
     
-    failed = []
-    for bench_dir in benches:
-        bench_name = bench_dir.name
-        
-        # Stop bench using docker-compose
-        success, output, error = run_command(
-            ["docker-compose", "down"],
-            cwd=bench_dir
-        )
-        if not success:
-            failed.append(f"{bench_name} (stop failed)")
-            continue
-        
+    # Stop bench using docker-compose
+    success, output, error = await run_command(
+        ["docker-compose", "down"],
+        cwd=bench_dir,
+        stack=stack_name
+    )
+    if not success:
+        result["message"] = f"stop failed: {error.strip()}"
+    else:
         # Start bench using docker-compose
-        success, output, error = run_command(
+        success, output, error = await run_command(
             ["docker-compose", "up", "-d"],
-            cwd=bench_dir
+            cwd=bench_dir,
+            stack=stack_name
         )
-        if not success:
-            failed.append(f"{bench_name} (start failed)")
+        result["success"] = success
+        result["message"] = "restarted" if success else f"start failed: {error.strip()}"
+    
+    result["duration"] = round(time.monotonic() - started, 1)
+    return result
+
+
+async def wait_bench_healthy(bench_dir: Path, timeout: float) -> bool:
+    """
+    Wait until a bench's backend container is running, and healthy if it has
+    a healthcheck, according to the container inventory
+    
+    The polling itself stays out of the job transcript (the inventory is a
+    read_only command); the caller records one summary line per bench.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        containers = await get_container_inventory(max_age=1)
+        backend = find_service_container(containers, bench_dir, "backend")
+        if backend and backend["State"] == "running" and backend["Health"] in (None, "healthy"):
+            return True
+        if time.monotonic() >= deadline:
+            return False
+        await asyncio.sleep(2)
+
+
+async def run_bench_tasks(stack_name: str, benches: List[Path],
+                          run_bench: Callable[[str, Path], Awaitable[Dict]],
+                          mode: str, concurrency: Optional[int], progress: Dict) -> List[Dict]:
+    """
+    Apply a per-bench step (restart, container swap) to benches
+    
+    "parallel" runs up to `concurrency` (default restart_concurrency) benches at
+    once. "rolling" runs `concurrency` (default rolling_batch) at a time and waits
+    for their backends to be healthy before the next batch; it stops at the
+    first bench that fails or stays unhealthy, leaving the rest untouched.
+    Results are added to progress["results"] as they come in; returns them in bench order.
+    """
+    if mode not in ("parallel", "rolling"):
+        raise HTTPException(status_code=400, detail=f"Unknown restart mode: {mode}")
+    progress.update(mode=mode, total=len(benches), done=0, results=[])
+    
+    async def one(bench_dir: Path, limit: asyncio.Semaphore) -> Dict:
+        async with limit:
+            result = await run_bench(stack_name, bench_dir)
+        progress["results"].append(result)
+        progress["done"] += 1
+        return result
+    
+    try:
+        if mode == "parallel":
+            limit = asyncio.Semaphore(min(concurrency or RESTART_CONCURRENCY, stack_fanout_limit(stack_name)))
+            await asyncio.gather(*(one(bench_dir, limit) for bench_dir in benches))
+        else:
+            batch_size = max(1, min(concurrency or ROLLING_BATCH, stack_fanout_limit(stack_name)))
+            limit = asyncio.Semaphore(batch_size)
+            for start in range(0, len(benches), batch_size):
+                batch = benches[start:start + batch_size]
+                results = await asyncio.gather(*(one(bench_dir, limit) for bench_dir in batch))
+                invalidate_container_inventory()
+                for bench_dir, result in zip(batch, results):
+                    if result["success"]:
+                        waited = time.monotonic()
+                        result["healthy"] = await wait_bench_healthy(bench_dir, HEALTH_TIMEOUT)
+                        result["health_wait"] = round(time.monotonic() - waited, 1)
+                        job = _current_job.get()
+                        if job:
+                            job["output"].append(
+                                f"{bench_dir.name}: {'healthy' if result['healthy'] else 'not healthy'} "
+                                f"after {result['health_wait']}s"
+                            )
+                        if not result["healthy"]:
+                            result["success"] = False
+                            result["message"] = f"not healthy after {HEALTH_TIMEOUT}s"
+                if not all(result["success"] for result in results):
+                    # Don't take more benches down while one is broken
+                    for bench_dir in benches[start + batch_size:]:
+                        progress["results"].append({
+                            "bench": bench_dir.name, "success": False,
+                            "message": "skipped", "duration": 0
+                        })
+                    break
+    finally:
+        invalidate_container_inventory()
+    
+    order = {bench_dir.name: i for i, bench_dir in enumerate(benches)}
+    progress["results"].sort(key=lambda result: order[result["bench"]])
+    return progress["results"]
+
+
+async def restart_stack(stack_name: str, mode: Optional[str] = None, concurrency: Optional[int] = None) -> tuple:
+    """
+    Restart an FM stack (all benches), in parallel or rolling mode (see run_bench_tasks)
+    Returns (success, message, data) with per-bench timing.
+    """
+    mode = mode or RESTART_MODE
+    
+    # For FM, we restart all benches in the stack
+    benches = stack_benches(stack_name)
+    if not benches:
+        return False, "No benches found in stack", None
+    
+    progress = {}
+    job = _current_job.get()
+    if job:
+        job["data"] = progress
     
+    results = await run_bench_tasks(stack_name, benches, restart_bench, mode, concurrency, progress)
+    failed = [f"{result['bench']} ({result['message']})" for result in results if not result["success"]]
     if failed:
-        return False, f"Failed to restart benches: {', '.join(failed)}"
+        return False, f"Failed to restart benches: {', '.join(failed)}", progress
     
-    return True, f"Stack restarted successfully ({len(benches)} benches)"
+    return True, f"Stack restarted successfully ({len(benches)} benches, {mode})", progress
 
 
-def restart_site(stack_name: str, site_name: str) -> tuple:
+async def restart_site(stack_name: str, site_name: str) -> tuple:
     """Restart a specific site"""
     try:
         # Find the bench that contains this site
         bench_path = find_site_bench(stack_name, site_name)
         
-        # Restart using docker-compose in the bench directory
-        success, output, error = run_command(
-            ["docker-compose", "restart", "backend"],
-            cwd=bench_path
-        )
+        containers = await get_container_inventory()
+        backend = find_service_container(containers, bench_path, "backend")
+        if backend:
+            success, output, error = await run_command(
+                ["docker", "restart", backend["Name"]],
+                stack=stack_name
+            )
+        else:
+            # Not in the inventory: let docker-compose resolve the service
+            success, output, error = await run_command(
+                ["docker-compose", "restart", "backend"],
+                cwd=bench_path,
+                stack=stack_name
+            )
+        invalidate_container_inventory()
         
         if not success:
             return False, f"Failed to restart site: {error}"
@@ -369,16 +1051,17 @@ def restart_site(stack_name: str, site_name: str) -> tuple:
         return False, f"Error: {str(e)}"
 
 
-def migrate_site(stack_name: str, site_name: str) -> tuple:
+async def migrate_site(stack_name: str, site_name: str) -> tuple:
     """Run migrate on a site using fm shell"""
     try:
         stack_path = get_stack_path(stack_name)
         
         # Use fm shell to execute bench migrate command
         # fm shell <site> -c "bench --site <site> migrate"
-        success, output, error = run_command(
+        success, output, error = await run_command(
             ["fm", "shell", site_name, "-c", f"bench --site {site_name} migrate"],
-            cwd=stack_path
+            cwd=stack_path,
+            stack=stack_name
         )
         
         if not success:
@@ -389,80 +1072,166 @@ def migrate_site(stack_name: str, site_name: str) -> tuple:
         return False, f"Error: {str(e)}"
 
 
-def backup_site(stack_name: str, site_name: str) -> tuple:
+async def backup_site(stack_name: str, site_name: str) -> tuple:
     """Backup a site using fm shell"""
     try:
         stack_path = get_stack_path(stack_name)
         bench_path = find_site_bench(stack_name, site_name)
         backup_dir = get_backup_path(stack_name, site_name)
         
-        timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+        created = time.time()
+        timestamp = datetime.fromtimestamp(created).strftime("%Y-%m-%d_%H-%M-%S")
         
         # Use fm shell to execute bench backup command
-        success, output, error = run_command(
-            ["fm", "shell", site_name, "-c", f"bench --site {site_name} backup"],
-            cwd=stack_path
+        started = time.monotonic()
+        backup_cmd = f"bench --site {site_name} backup"
+        if BACKUP_WITH_FILES:
+            backup_cmd += " --with-files"
+        success, output, error = await run_command(
+            ["fm", "shell", site_name, "-c", backup_cmd],
+            cwd=stack_path,
+            stack=stack_name
         )
+        duration = time.monotonic() - started
         
         if not success:
             return False, f"Failed to backup site: {error}"
         
-        # Find the backup files in the bench workspace
+        # Find the backup bench just wrote in the bench workspace
         source_backup_dir = bench_path / "workspace" / "frappe-bench" / "sites" / site_name / "private" / "backups"
+        sources = await run_in_threadpool(find_bench_backup, source_backup_dir, output)
         
-        if source_backup_dir.exists():
-            # Find the latest backup files
-            backup_files = sorted(source_backup_dir.glob("*.sql.gz"), key=lambda x: x.stat().st_mtime, reverse=True)
+        if sources:
+            # Move/link/copy into our backup directory (off the event loop)
+            dest_file, artifacts, method = await run_in_threadpool(
+                ingest_backup, sources, backup_dir, timestamp, BACKUP_SOURCE_CLEANUP == "remove"
+            )
+            size = dest_file.stat().st_size
+            if BACKUP_STORAGE == "dedup":
+                checksum = await run_in_threadpool(store_dedup_backup, dest_file)
+            else:
+                checksum = await run_in_threadpool(file_checksum, dest_file)
+            await run_in_threadpool(
+                record_backup, stack_name, site_name, dest_file,
+                size=size, checksum=checksum, created=created, source=str(sources["database"]),
+                duration=duration, artifacts=artifacts, storage=BACKUP_STORAGE
+            )
+            logger.info(f"Ingested backup of {site_name} into {dest_file} ({method})")
             
-            if backup_files:
-                latest_backup = backup_files[0]
-                # Copy to our backup directory
-                import shutil
-                dest_file = backup_dir / f"{timestamp}.sql.gz"
-                shutil.copy2(latest_backup, dest_file)
-                
-                return True, f"Site '{site_name}' backed up successfully to {dest_file}"
+            return True, f"Site '{site_name}' backed up successfully to {dest_file}"
         
         return True, "Backup command executed successfully"
     except Exception as e:
         return False, f"Error: {str(e)}"
 
 
-def update_stack(stack_name: str) -> tuple:
-    """Update an FM stack"""
+# Compose file names docker-compose looks for in a project directory
+COMPOSE_FILES = ("compose.yaml", "compose.yml", "docker-compose.yaml", "docker-compose.yml")
+
+
+async def pull_images(stack_name: str, project_dir: Path, name: str) -> Dict:
+    """Pull the images of one compose project, timing it"""
+    started = time.monotonic()
+    success, output, error = await run_command(
+        ["docker-compose", "pull"],
+        cwd=project_dir,
+        stack=stack_name,
+        timeout=PULL_TIMEOUT
+    )
+    return {
+        "bench": name,
+        "success": success,
+        "message": "pulled" if success else f"pull failed: {error.strip()}",
+        "duration": round(time.monotonic() - started, 1)
+    }
+
+
+async def swap_bench(stack_name: str, bench_dir: Path) -> Dict:
+    """Recreate a bench's containers whose image changed (docker-compose up -d), timing it"""
+    started = time.monotonic()
+    success, output, error = await run_command(
+        ["docker-compose", "up", "-d"],
+        cwd=bench_dir,
+        stack=stack_name
+    )
+    return {
+        "bench": bench_dir.name,
+        "success": success,
+        "message": "updated" if success else f"up failed: {error.strip()}",
+        "duration": round(time.monotonic() - started, 1)
+    }
+
+
+async def update_stack(stack_name: str, mode: Optional[str] = None, concurrency: Optional[int] = None) -> tuple:
+    """
+    Update an FM stack
+    
+    Images of every bench (and of the stack root, if it has its own compose file)
+    are pulled first, in parallel. Only when every pull succeeded are containers
+    recreated with `up -d`, bench by bench in parallel or rolling mode, so the
+    downtime is just the container swap.
+    Returns (success, message, data) with per-bench pull and swap timing.
+    """
     stack_path = get_stack_path(stack_name)
+    mode = mode or RESTART_MODE
+    if mode not in ("parallel", "rolling"):
+        raise HTTPException(status_code=400, detail=f"Unknown restart mode: {mode}")
+    benches = stack_benches(stack_name)
+    projects = [(bench_dir, bench_dir.name) for bench_dir in benches]
+    root_compose = any((stack_path / name).exists() for name in COMPOSE_FILES)
+    if root_compose:
+        projects.append((stack_path, "."))
+    if not projects:
+        return False, "No compose projects found in stack", None
+    
+    progress = {"phase": "pull", "pull": []}
+    job = _current_job.get()
+    if job:
+        job["data"] = progress
     
     # Pull latest images
-    success, output, error = run_command(
-        ["docker-compose", "pull"],
-        cwd=stack_path
-    )
+    limit = asyncio.Semaphore(min(PULL_CONCURRENCY, stack_fanout_limit(stack_name)))
     
-    if not success:
-        return False, f"Failed to pull images: {error}"
+    async def pull(project_dir: Path, name: str) -> Dict:
+        async with limit:
+            result = await pull_images(stack_name, project_dir, name)
+        progress["pull"].append(result)
+        return result
+    
+    pulls = await asyncio.gather(*(pull(project_dir, name) for project_dir, name in projects))
+    progress["pull"] = list(pulls)
+    failed = [f"{result['bench']} ({result['message']})" for result in pulls if not result["success"]]
+    if failed:
+        return False, f"Failed to pull images, nothing was restarted: {', '.join(failed)}", progress
     
     # Restart with new images
-    success, output, error = run_command(
-        ["docker-compose", "up", "-d"],
-        cwd=stack_path
-    )
+    progress["phase"] = "swap"
+    results = await run_bench_tasks(stack_name, benches, swap_bench, mode, concurrency, progress)
+    if root_compose:
+        result = await swap_bench(stack_name, stack_path)
+        result["bench"] = "."
+        results.append(result)
+    invalidate_container_inventory()
     
-    if not success:
-        return False, f"Failed to restart with new images: {error}"
+    failed = [f"{result['bench']} ({result['message']})" for result in results if not result["success"]]
+    if failed:
+        return False, f"Failed to restart with new images: {', '.join(failed)}", progress
     
-    return True, "Stack updated successfully"
+    return True, f"Stack updated successfully ({len(benches)} benches, {mode})", progress
 
 
-def get_site_logs(stack_name: str, site_name: str, lines: int = 100) -> tuple:
+async def get_site_logs(stack_name: str, site_name: str, lines: int = 100) -> tuple:
     """Get logs for a site using fm logs"""
     try:
         stack_path = get_stack_path(stack_name)
         
         # Use fm logs command
         # fm logs <site> --follow=false --tail=<lines>
-        success, output, error = run_command(
+        success, output, error = await run_command(
             ["fm", "logs", site_name, "--follow=false", f"--tail={lines}"],
-            cwd=stack_path
+            cwd=stack_path,
+            stack=stack_name,
+            read_only=True
         )
         
         if not success:
@@ -473,40 +1242,94 @@ def get_site_logs(stack_name: str, site_name: str, lines: int = 100) -> tuple:
         return False, f"Error: {str(e)}"
 
 
-def list_site_files(stack_name: str, site_name: str, subpath: str = "") -> tuple:
-    """List files in a site directory"""
+def list_site_files(stack_name: str, site_name: str, subpath: str = "", sort: str = "name",
+                    order: str = "asc", name: Optional[str] = None, min_size: Optional[int] = None,
+                    max_size: Optional[int] = None, modified_after: Optional[str] = None,
+                    modified_before: Optional[str] = None, cursor: Optional[str] = None,
+                    limit: Optional[int] = None, recursive: bool = False) -> tuple:
+    """
+    List one page of a site directory
+    
+    Entries are sorted and filtered server-side; pass the returned `next_cursor`
+    back to get the following page. With `recursive`, directories report the
+    total size and file count of everything below them.
+    """
+    if sort not in LIST_SORT_KEYS:
+        raise HTTPException(status_code=400, detail=f"Unknown sort: {sort}")
+    if order not in ("asc", "desc"):
+        raise HTTPException(status_code=400, detail=f"Unknown order: {order}")
     try:
-        # Find the bench that contains this site
-        bench_path = find_site_bench(stack_name, site_name)
-        
-        # Build the site directory path in the correct bench
-        site_dir = bench_path / "workspace" / "frappe-bench" / "sites" / site_name
-        
-        if not site_dir.exists():
-            return False, f"Site directory not found at {site_dir}"
-        
-        # If subpath provided, append it
-        if subpath:
-            site_dir = site_dir / subpath
-            if not site_dir.exists():
-                return False, f"Path not found: {subpath}"
-        
-        # List files and directories
-        try:
-            items = []
-            for item in sorted(site_dir.iterdir()):
-                items.append({
-                    "name": item.name,
-                    "type": "dir" if item.is_dir() else "file",
-                    "size": item.stat().st_size if item.is_file() else 0,
-                    "modified": datetime.fromtimestamp(item.stat().st_mtime).isoformat()
-                })
-            
-            return True, {"path": str(site_dir), "items": items}
-        except Exception as e:
-            return False, f"Failed to list files: {str(e)}"
-    except FileNotFoundError as e:
-        return False, str(e)
+        after = datetime.fromisoformat(modified_after).timestamp() if modified_after else None
+        before = datetime.fromisoformat(modified_before).timestamp() if modified_before else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="modified_after/modified_before must be ISO dates")
+    
+    site_dir = resolve_site_file(stack_name, site_name, subpath) if subpath else get_site_dir(stack_name, site_name)
+    if not site_dir.is_dir():
+        return False, f"Path not found: {subpath}" if subpath else f"Site directory not found at {site_dir}"
+    
+    try:
+        if recursive:
+            entries = []
+            for entry in scan_directory(str(site_dir)):
+                if entry["type"] == "dir":
+                    size, files = dir_usage(os.path.join(site_dir, entry["name"]))
+                    entry = dict(entry, size=size, files=files)
+                entries.append(entry)
+            entries.sort(key=LIST_SORT_KEYS[sort])
+        else:
+            entries = sorted_directory(str(site_dir), sort)
+    except OSError as e:
+        return False, f"Failed to list files: {str(e)}"
+    
+    pattern = name.lower() if name else None
+    matches = [
+        entry for entry in (reversed(entries) if order == "desc" else entries)
+        if (pattern is None or fnmatch.fnmatchcase(entry["name"].lower(), pattern))
+        and (min_size is None or entry["size"] >= min_size)
+        and (max_size is None or entry["size"] <= max_size)
+        and (after is None or entry["mtime"] >= after)
+        and (before is None or entry["mtime"] < before)
+    ]
+    
+    start = 0
+    if cursor:
+        # Resume after the last entry of the previous page, so entries added
+        # or removed meanwhile do not shift the pages
+        last = decode_list_cursor(cursor, sort, order)
+        sort_key = LIST_SORT_KEYS[sort]
+        if order == "asc":
+            start = next((i for i, entry in enumerate(matches) if sort_key(entry) > last), len(matches))
+        else:
+            start = next((i for i, entry in enumerate(matches) if sort_key(entry) < last), len(matches))
+    
+    limit = max(1, min(limit or LIST_PAGE_SIZE, LIST_PAGE_MAX))
+    page = matches[start:start + limit]
+    next_cursor = None
+    if start + limit < len(matches):
+        next_cursor = encode_list_cursor(sort, order, LIST_SORT_KEYS[sort](page[-1]))
+    
+    items = []
+    for entry in page:
+        item = {
+            "name": entry["name"],
+            "type": entry["type"],
+            "size": entry["size"],
+            "modified": datetime.fromtimestamp(entry["mtime"]).isoformat()
+        }
+        if "files" in entry:
+            item["files"] = entry["files"]
+        items.append(item)
+    
+    result = {
+        "path": str(site_dir),
+        "items": items,
+        "total": len(matches),
+        "next_cursor": next_cursor
+    }
+    if recursive:
+        result["total_size"], result["total_files"] = dir_usage(str(site_dir))
+    return True, result
 
 
 def open_site_console(stack_name: str, site_name: str) -> tuple:
@@ -522,106 +1345,1740 @@ def open_site_console(stack_name: str, site_name: str) -> tuple:
         return False, f"Error: {str(e)}"
 
 
-# API Endpoints
-@app.get("/")
-def root():
-    """Health check"""
-    return {"status": "healthy", "service": "FM Agent", "version": "1.0.0"}
-
-
-@app.get("/stacks", dependencies=[Depends(verify_token)])
-def get_stacks():
-    """Get all configured stacks"""
-    stacks = []
-    for name, config in STACKS_CONFIG.items():
+# Stack-wide Actions
+async def run_site_tasks(stack_name: str, sites: List[str], run_site: Callable[[str, str], Awaitable[tuple]],
+                         kind: str, host_limit: int, bench_limit: int, concurrency: Optional[int] = None,
+                         fail_fast: bool = False) -> List[Dict]:
+    """
+    Run a per-site action for many sites concurrently
+    
+    At most `host_limit` sites of this kind run at once on the host,
+    `bench_limit` per bench, and `concurrency` in this run. With `fail_fast`,
+    sites not started yet are skipped once one fails (running ones finish).
+    Inside a job, progress is kept in the job's data. Returns one result per
+    site, in the order given, each with the site's own command transcript.
+    """
+    progress = {"total": len(sites), "done": 0, "failed": 0, "running": [], "results": []}
+    job = _current_job.get()
+    if job:
+        job["data"] = progress
+    run_limit = asyncio.Semaphore(min(concurrency or max(len(sites), 1), stack_fanout_limit(stack_name)))
+    
+    async def one(site_name: str) -> Dict:
+        result = {"site": site_name, "bench": None, "skipped": False}
+        output = deque(maxlen=JOB_OUTPUT_LINES)
+        _site_output.set(output)
+        started = time.monotonic()
         try:
-            status_info = get_stack_status(name)
-            stacks.append(status_info)
+            bench = find_site_bench(stack_name, site_name).name
+            result["bench"] = bench
+            async with run_limit, \
+                    get_pool_semaphore((kind,), host_limit), \
+                    get_pool_semaphore((kind, stack_name, bench), bench_limit):
+                if fail_fast and progress["failed"]:
+                    success, message = False, "Skipped after an earlier failure"
+                    result["skipped"] = True
+                else:
+                    started = time.monotonic()
+                    progress["running"].append(site_name)
+                    try:
+                        success, message = await run_site(stack_name, site_name)
+                    finally:
+                        progress["running"].remove(site_name)
         except Exception as e:
-            logger.error(f"Error getting status for {name}: {e}")
-            stacks.append({
-                "name": name,
-                "path": config["path"],
-                "type": config["type"],
-                "status": "error",
-                "error": str(e)
-            })
+            success, message = False, f"Error: {str(e)}"
+        
+        result.update(
+            success=success,
+            message=message,
+            duration=0 if result["skipped"] else round(time.monotonic() - started, 1),
+            output="\n".join(output)
+        )
+        progress["results"].append(result)
+        progress["done"] += 1
+        if not success and not result["skipped"]:
+            progress["failed"] += 1
+        return result
     
-    return {"stacks": stacks}
+    # Each site runs in its own task, so its _site_output stays its own
+    return list(await asyncio.gather(*(one(site_name) for site_name in sites)))
 
 
-@app.get("/stacks/{stack_name}", dependencies=[Depends(verify_token)])
-def get_stack(stack_name: str):
-    """Get detailed status of a specific stack"""
-    try:
-        status_info = get_stack_status(stack_name)
-        sites = list_sites(stack_name)
-        status_info["sites"] = sites
-        return status_info
-    except HTTPException:
-        raise
-    except Exception as e:
+async def backup_stack(stack_name: str, sites: Optional[List[str]] = None) -> tuple:
+    """
+    Back up every site of a stack (or the given ones) concurrently
+    Returns (success, message, data) with per-site results and durations
+    """
+    if not sites:
+        sites = [site["name"] for site in await list_sites(stack_name)]
+    
+    results = await run_site_tasks(
+        stack_name, sites, backup_site, "backup", BACKUP_MAX_CONCURRENT, BACKUP_MAX_PER_BENCH
+    )
+    failed = [result["site"] for result in results if not result["success"]]
+    message = f"Backed up {len(results) - len(failed)}/{len(results)} sites of '{stack_name}'"
+    if failed:
+        message += f"; failed: {', '.join(failed)}"
+    return not failed, message, {
+        "total": len(results), "done": len(results), "failed": len(failed), "running": [], "results": results
+    }
+
+
+async def migrate_stack(stack_name: str, sites: Optional[List[str]] = None,
+                        concurrency: Optional[int] = None, fail_fast: bool = False) -> tuple:
+    """
+    Migrate every site of a stack (or the given ones) on a pool of workers
+    Returns (success, message, data) with per-site results, durations and output
+    """
+    if not sites:
+        sites = [site["name"] for site in await list_sites(stack_name)]
+    
+    results = await run_site_tasks(
+        stack_name, sites, migrate_site, "migrate", MIGRATE_CONCURRENCY, MIGRATE_PER_BENCH,
+        concurrency=min(concurrency or MIGRATE_CONCURRENCY, MIGRATE_CONCURRENCY),
+        fail_fast=fail_fast
+    )
+    failed = [result["site"] for result in results if not result["success"] and not result["skipped"]]
+    skipped = sum(1 for result in results if result["skipped"])
+    migrated = len(results) - len(failed) - skipped
+    message = f"Migrated {migrated}/{len(results)} sites of '{stack_name}'"
+    if failed:
+        message += f"; failed: {', '.join(failed)}"
+    if skipped:
+        message += f"; skipped {skipped}"
+    return not failed and not skipped, message, {
+        "total": len(results), "done": len(results), "failed": len(failed), "running": [], "results": results
+    }
+
+
+# File Streaming
+FILE_CHUNK_SIZE = 64 * 1024
+
+
+def get_site_dir(stack_name: str, site_name: str) -> Path:
+    """Get the directory of a site inside its bench"""
+    bench_path = find_site_bench(stack_name, site_name)
+    return bench_path / "workspace" / "frappe-bench" / "sites" / site_name
+
+
+def resolve_site_file(stack_name: str, site_name: str, file_path: str) -> Path:
+    """Resolve a path relative to a site directory"""
+    # Security: prevent path traversal
+    if ".." in file_path or file_path.startswith("/"):
+        raise HTTPException(status_code=400, detail="Invalid file path")
+    try:
+        return get_site_dir(stack_name, site_name) / file_path
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+
+def file_etag(stat: os.stat_result) -> str:
+    """Validator that changes whenever a file is modified"""
+    return f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+
+def parse_byte_range(range_header: Optional[str], size: int) -> Optional[tuple]:
+    """
+    Parse a single-range "bytes=start-end" header
+    Returns inclusive (start, end), or None to serve the whole file
+    """
+    if not range_header or not range_header.startswith("bytes="):
+        return None
+    spec = range_header[len("bytes="):].strip()
+    if "," in spec:
+        # Multipart ranges are not supported; the whole file is a valid answer
+        return None
+    
+    first, _, last = spec.partition("-")
+    try:
+        if first:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+        else:
+            start = max(0, size - int(last))
+            end = size - 1
+    except ValueError:
+        return None
+    
+    if start >= size or start > end:
+        raise HTTPException(
+            status_code=416,
+            detail="Requested range not satisfiable",
+            headers={"Content-Range": f"bytes */{size}"}
+        )
+    return start, end
+
+
+def iter_file_range(path: Path, start: int, length: int):
+    """Yield a byte range of a file in chunks"""
+    with open(path, "rb") as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(FILE_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def file_range_response(request: Request, path: Path, media_type: str,
+                        filename: Optional[str] = None, window: Optional[tuple] = None) -> Response:
+    """
+    Stream a file honoring Range, If-Range and If-None-Match
+    
+    `window` forces an inclusive (start, end) byte range regardless of headers.
+    """
+    stat = path.stat()
+    size = stat.st_size
+    etag = file_etag(stat)
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+        "Last-Modified": formatdate(stat.st_mtime, usegmt=True)
+    }
+    if filename:
+        headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+    
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    
+    byte_range = window
+    if byte_range is None:
+        # A stale If-Range validator means the client must get the whole new file
+        if_range = request.headers.get("if-range")
+        if not if_range or if_range == etag:
+            byte_range = parse_byte_range(request.headers.get("range"), size)
+    
+    if byte_range is None:
+        headers["Content-Length"] = str(size)
+        return StreamingResponse(iter_file_range(path, 0, size), media_type=media_type, headers=headers)
+    
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(
+        iter_file_range(path, start, end - start + 1),
+        status_code=206,
+        media_type=media_type,
+        headers=headers
+    )
+
+
+# Directory Listing
+# One os.scandir pass (and one stat per entry) per directory change; listings are
+# reused while the directory's mtime is unchanged, for at most CACHE_TTL seconds
+# since file sizes can change without touching the directory
+LIST_PAGE_SIZE = 500
+LIST_PAGE_MAX = 5000
+LISTING_CACHE_SIZE = 32
+DIR_USAGE_CACHE_SIZE = 50000
+
+LIST_SORT_KEYS = {
+    "name": lambda entry: (entry["name"],),
+    "size": lambda entry: (entry["size"], entry["name"]),
+    "modified": lambda entry: (entry["mtime"], entry["name"]),
+}
+# Types of each sort key's fields, used to validate cursors sent back by clients
+LIST_SORT_KEY_TYPES = {
+    "name": (str,),
+    "size": (int, str),
+    "modified": ((int, float), str),
+}
+
+_dir_listings: "OrderedDict[str, dict]" = OrderedDict()
+# Recursive (size, file count) per directory path, with the time it was computed
+_dir_usage: "OrderedDict[str, tuple]" = OrderedDict()
+# Sync routes run in a threadpool: guards both caches (not the scans themselves)
+_dir_cache_lock = threading.Lock()
+
+
+def scan_directory(path: str) -> List[dict]:
+    """Read a directory's entries with one stat per entry"""
+    entries = []
+    with os.scandir(path) as it:
+        for entry in it:
+            try:
+                info = entry.stat()
+            except OSError:
+                # Dangling symlink
+                info = entry.stat(follow_symlinks=False)
+            is_dir = stat.S_ISDIR(info.st_mode)
+            entries.append({
+                "name": entry.name,
+                "type": "dir" if is_dir else "file",
+                "size": 0 if is_dir else info.st_size,
+                "mtime": info.st_mtime
+            })
+    return entries
+
+
+def sorted_directory(path: str, sort: str) -> List[dict]:
+    """Directory entries sorted ascending by `sort`, from cache when still valid"""
+    mtime_ns = os.stat(path).st_mtime_ns
+    with _dir_cache_lock:
+        listing = _dir_listings.get(path)
+    if (listing is None or listing["mtime_ns"] != mtime_ns
+            or time.monotonic() - listing["scanned_at"] > CACHE_TTL):
+        listing = {
+            "mtime_ns": mtime_ns,
+            "scanned_at": time.monotonic(),
+            "entries": scan_directory(path),
+            "sorted": {}
+        }
+    with _dir_cache_lock:
+        _dir_listings[path] = listing
+        _dir_listings.move_to_end(path)
+        while len(_dir_listings) > LISTING_CACHE_SIZE:
+            _dir_listings.popitem(last=False)
+    
+    entries = listing["sorted"].get(sort)
+    if entries is None:
+        entries = sorted(listing["entries"], key=LIST_SORT_KEYS[sort])
+        with _dir_cache_lock:
+            listing["sorted"][sort] = entries
+    return entries
+
+
+def dir_usage(path: str) -> tuple:
+    """
+    Total size and file count below a directory (symlinks are not followed)
+    Every subdirectory's total is cached for DIR_SIZE_TTL seconds as well.
+    """
+    with _dir_cache_lock:
+        cached = _dir_usage.get(path)
+    if cached and time.monotonic() - cached[2] <= DIR_SIZE_TTL:
+        return cached[0], cached[1]
+    
+    size = files = 0
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        sub_size, sub_files = dir_usage(entry.path)
+                        size += sub_size
+                        files += sub_files
+                    else:
+                        size += entry.stat(follow_symlinks=False).st_size
+                        files += 1
+                except OSError:
+                    continue
+    except OSError:
+        pass
+    
+    with _dir_cache_lock:
+        _dir_usage[path] = (size, files, time.monotonic())
+        _dir_usage.move_to_end(path)
+        while len(_dir_usage) > DIR_USAGE_CACHE_SIZE:
+            _dir_usage.popitem(last=False)
+    return size, files
+
+
+def encode_list_cursor(sort: str, order: str, key: tuple) -> str:
+    """Opaque cursor holding the listing order and the sort key of the last entry returned"""
+    payload = {"sort": sort, "order": order, "key": list(key)}
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode()
+
+
+def decode_list_cursor(cursor: str, sort: str, order: str) -> tuple:
+    """Sort key stored in a cursor, checked against the listing it is used with"""
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        key = tuple(payload["key"])
+        cursor_sort, cursor_order = payload["sort"], payload["order"]
+    except (ValueError, TypeError, KeyError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    
+    types = LIST_SORT_KEY_TYPES[sort]
+    if cursor_sort != sort or cursor_order != order:
+        raise HTTPException(status_code=400, detail="Cursor does not match the sort order")
+    if len(key) != len(types) or not all(
+        isinstance(value, kind) and not isinstance(value, bool) for value, kind in zip(key, types)
+    ):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return key
+
+
+# Atomic File Writes
+# Content goes to a temp file in the same directory, is fsynced, then renamed
+# over the target, so readers see either the old file or the new one, never half.
+# Serializes the If-Match check with the rename that replaces a file
+_file_write_lock = threading.Lock()
+
+
+def check_if_match(if_match: Optional[str], path: Path, create: bool = False) -> Optional[os.stat_result]:
+    """
+    Check an If-Match precondition against a file's current ETag
+    Returns the file's stat, or None for a new file when `create` is set
+    """
+    try:
+        current = path.stat()
+    except FileNotFoundError:
+        if if_match:
+            raise HTTPException(status_code=412, detail="File no longer exists")
+        if not create:
+            raise HTTPException(status_code=404, detail="File not found")
+        if not path.parent.is_dir():
+            raise HTTPException(status_code=404, detail="Directory not found")
+        return None
+    
+    if not stat.S_ISREG(current.st_mode):
+        raise HTTPException(status_code=400, detail="Path is not a file")
+    
+    if if_match and if_match.strip() != "*":
+        etag = file_etag(current)
+        if etag not in [tag.strip() for tag in if_match.split(",")]:
+            raise HTTPException(
+                status_code=412,
+                detail="File was modified by someone else",
+                headers={"ETag": etag}
+            )
+    return current
+
+
+def open_temp_file(path: Path) -> tuple:
+    """Create a temp file next to `path` so the final rename stays on one filesystem"""
+    fd, temp_name = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    return os.fdopen(fd, "wb"), Path(temp_name)
+
+
+def discard_temp_file(f, temp_path: Path):
+    """Remove a temp file that will not be committed"""
+    f.close()
+    try:
+        temp_path.unlink()
+    except FileNotFoundError:
+        pass
+
+
+def commit_temp_file(f, temp_path: Path, path: Path, if_match: Optional[str] = None,
+                     create: bool = False) -> os.stat_result:
+    """Flush a fully written temp file to disk and rename it over `path`"""
+    try:
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        with _file_write_lock:
+            current = check_if_match(if_match, path, create)
+            # Keep the replaced file's permissions and owner
+            if current is not None:
+                os.chmod(temp_path, stat.S_IMODE(current.st_mode))
+                try:
+                    os.chown(temp_path, current.st_uid, current.st_gid)
+                except PermissionError:
+                    pass
+            else:
+                os.chmod(temp_path, 0o644)
+            os.replace(temp_path, path)
+    except BaseException:
+        discard_temp_file(f, temp_path)
+        raise
+    
+    # Make the rename itself durable
+    dir_fd = os.open(path.parent, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+    return path.stat()
+
+
+def atomic_write(path: Path, data: bytes, if_match: Optional[str] = None,
+                 create: bool = False) -> os.stat_result:
+    """Replace a file's content atomically"""
+    check_if_match(if_match, path, create)
+    f, temp_path = open_temp_file(path)
+    try:
+        f.write(data)
+    except BaseException:
+        discard_temp_file(f, temp_path)
+        raise
+    return commit_temp_file(f, temp_path, path, if_match, create)
+
+
+def patch_file(path: Path, ops: List[FilePatchOp], if_match: str) -> os.stat_result:
+    """
+    Apply splice operations to a file atomically
+    
+    Each op deletes `delete` bytes at byte `offset` of the current file and
+    inserts `insert` there. Offsets all refer to the file as it is before the
+    patch, so ops must not overlap.
+    """
+    size = check_if_match(if_match, path).st_size
+    ops = sorted(ops, key=lambda op: op.offset)
+    position = 0
+    for op in ops:
+        if op.offset < position or op.delete < 0 or op.offset + op.delete > size:
+            raise HTTPException(status_code=400, detail="Patch operations overlap or fall outside the file")
+        position = op.offset + op.delete
+    
+    f, temp_path = open_temp_file(path)
+    try:
+        with open(path, "rb") as src:
+            for op in ops:
+                # Copy the unchanged bytes up to this op, then splice
+                remaining = op.offset - src.tell()
+                while remaining > 0:
+                    chunk = src.read(min(FILE_CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    remaining -= len(chunk)
+                f.write(op.insert.encode())
+                src.seek(op.offset + op.delete)
+            shutil.copyfileobj(src, f, FILE_CHUNK_SIZE)
+    except BaseException:
+        discard_temp_file(f, temp_path)
+        raise
+    return commit_temp_file(f, temp_path, path, if_match)
+
+
+# Backup Catalog
+# One row per backup under backups.base_path, so listings and "latest" lookups
+# are index queries instead of globbing and stat-ing the backup tree.
+# Rows found on disk by a rebuild have no checksum, source or duration.
+# For deduplicated backups (storage "dedup") size and checksum are logical:
+# the size of the .sql.gz as taken and the sha256 of its uncompressed SQL. A
+# download rebuilds the .sql.gz, which differs from the original in both.
+# Companion archive suffixes: "-files.tar", "-private-files.tar" (or .tgz)
+BACKUP_ARTIFACT_RE = re.compile(r"-(private-)?files\.(tar|tgz|tar\.gz)")
+# ioctl that makes a file share another's extents (reflink) on btrfs/xfs
+FICLONE = 0x40049409
+
+CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS backups (
+    id INTEGER PRIMARY KEY,
+    stack TEXT NOT NULL,
+    site TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    checksum TEXT,
+    created REAL NOT NULL,
+    source TEXT,
+    duration REAL,
+    artifacts TEXT,
+    artifacts_size INTEGER NOT NULL DEFAULT 0,
+    storage TEXT NOT NULL DEFAULT 'files',
+    UNIQUE (stack, site, filename)
+);
+CREATE INDEX IF NOT EXISTS backups_site_created ON backups (stack, site, created);
+CREATE INDEX IF NOT EXISTS backups_stack_size ON backups (stack, size);
+"""
+
+_catalog = {"db": None}
+_catalog_lock = threading.Lock()
+
+
+def get_catalog() -> sqlite3.Connection:
+    """Open the catalog on first use, building it from disk if it is new (hold _catalog_lock)"""
+    if _catalog["db"] is None:
+        path = Path(BACKUP_CATALOG_PATH)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        is_new = not path.exists()
+        db = sqlite3.connect(str(path), check_same_thread=False)
+        db.row_factory = sqlite3.Row
+        db.execute("PRAGMA journal_mode=WAL")
+        db.executescript(CATALOG_SCHEMA)
+        # Catalogs created before companion files were tracked
+        columns = {row["name"] for row in db.execute("PRAGMA table_info(backups)")}
+        if "artifacts" not in columns:
+            db.execute("ALTER TABLE backups ADD COLUMN artifacts TEXT")
+            db.execute("ALTER TABLE backups ADD COLUMN artifacts_size INTEGER NOT NULL DEFAULT 0")
+        # Catalogs created before deduplicated backups were labeled
+        if "storage" not in columns:
+            db.execute("ALTER TABLE backups ADD COLUMN storage TEXT NOT NULL DEFAULT 'files'")
+            base = Path(BACKUPS_CONFIG["base_path"])
+            with db:
+                db.executemany("UPDATE backups SET storage = 'dedup' WHERE id = ?", [
+                    (row["id"],) for row in db.execute("SELECT id, stack, site, filename FROM backups")
+                    if (base / row["stack"] / row["site"] / (row["filename"] + MANIFEST_SUFFIX)).exists()
+                ])
+        _catalog["db"] = db
+        if is_new:
+            logger.info(f"Building backup catalog at {path}")
+            sync_catalog(db)
+    return _catalog["db"]
+
+
+def catalog_query(sql: str, params: tuple = ()) -> List[sqlite3.Row]:
+    """Run a read query against the catalog"""
+    with _catalog_lock:
+        return get_catalog().execute(sql, params).fetchall()
+
+
+def record_backup(stack_name: str, site_name: str, path: Path, size: Optional[int] = None,
+                  checksum: Optional[str] = None, created: Optional[float] = None,
+                  source: Optional[str] = None, duration: Optional[float] = None,
+                  artifacts: Optional[List[Path]] = None, storage: str = "files"):
+    """Add (or replace) a backup file's catalog row (size and created default to the file's)"""
+    if size is None or created is None:
+        file_stat = path.stat()
+        size = file_stat.st_size if size is None else size
+        created = file_stat.st_mtime if created is None else created
+    artifact_names = [artifact.name for artifact in artifacts or []]
+    artifacts_size = sum(artifact.stat().st_size for artifact in artifacts or [])
+    with _catalog_lock:
+        db = get_catalog()
+        with db:
+            db.execute(
+                """INSERT INTO backups (stack, site, filename, size, checksum, created, source, duration,
+                                        artifacts, artifacts_size, storage)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                   ON CONFLICT (stack, site, filename) DO UPDATE SET
+                       size = excluded.size, checksum = excluded.checksum, created = excluded.created,
+                       source = excluded.source, duration = excluded.duration,
+                       artifacts = excluded.artifacts, artifacts_size = excluded.artifacts_size,
+                       storage = excluded.storage""",
+                (stack_name, site_name, path.name, size, checksum, created, source, duration,
+                 json.dumps(artifact_names), artifacts_size, storage)
+            )
+
+
+def sync_catalog(db: sqlite3.Connection) -> dict:
+    """
+    Reconcile the catalog with the backup files on disk (hold _catalog_lock)
+    Files whose size is unchanged keep their row; missing files lose theirs.
+    """
+    known = {
+        (row["stack"], row["site"], row["filename"]): row["size"]
+        for row in db.execute("SELECT stack, site, filename, size FROM backups")
+    }
+    found = set()
+    added = 0
+    base = Path(BACKUPS_CONFIG["base_path"])
+    
+    with db:
+        for stack_dir in (os.scandir(base) if base.is_dir() else []):
+            if stack_dir.name.startswith(".") or not stack_dir.is_dir(follow_symlinks=False):
+                continue
+            for site_dir in os.scandir(stack_dir.path):
+                if not site_dir.is_dir(follow_symlinks=False):
+                    continue
+                entries = {entry.name: entry for entry in os.scandir(site_dir.path)}
+                for name, entry in entries.items():
+                    # Deduplicated backups are cataloged under their .sql.gz name
+                    filename = name[:-len(MANIFEST_SUFFIX)] if name.endswith(MANIFEST_SUFFIX) else name
+                    if not filename.endswith(".sql.gz") or not entry.is_file(follow_symlinks=False):
+                        continue
+                    key = (stack_dir.name, site_dir.name, filename)
+                    found.add(key)
+                    file_stat = entry.stat(follow_symlinks=False)
+                    if filename == name:
+                        size = file_stat.st_size
+                    elif key in known:
+                        # Manifests never change once written
+                        continue
+                    else:
+                        size = json.loads(Path(entry.path).read_text())["size"]
+                    if known.get(key) == size:
+                        continue
+                    stem = filename[:-len(".sql.gz")]
+                    artifacts = sorted(
+                        other for other in entries
+                        if BACKUP_ARTIFACT_RE.fullmatch(other[len(stem):]) and other.startswith(stem)
+                    )
+                    db.execute(
+                        """INSERT INTO backups (stack, site, filename, size, created, artifacts, artifacts_size,
+                                                storage)
+                           VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                           ON CONFLICT (stack, site, filename) DO UPDATE SET
+                               size = excluded.size, checksum = NULL, created = excluded.created,
+                               artifacts = excluded.artifacts, artifacts_size = excluded.artifacts_size,
+                               storage = excluded.storage""",
+                        key + (size, file_stat.st_mtime, json.dumps(artifacts),
+                               sum(entries[other].stat().st_size for other in artifacts),
+                               "files" if filename == name else "dedup")
+                    )
+                    added += 1
+        
+        removed = known.keys() - found
+        db.executemany("DELETE FROM backups WHERE stack = ? AND site = ? AND filename = ?", removed)
+    
+    return {"added": added, "removed": len(removed), "total": len(found)}
+
+
+def rebuild_catalog() -> dict:
+    """Re-scan backups.base_path into the catalog"""
+    with _catalog_lock:
+        return sync_catalog(get_catalog())
+
+
+def backup_row(row: sqlite3.Row) -> dict:
+    """Catalog row as returned by the API"""
+    return {
+        "filename": row["filename"],
+        "size": row["size"],
+        "created": datetime.fromtimestamp(row["created"]).isoformat(),
+        "checksum": row["checksum"],
+        "source": row["source"],
+        "duration": round(row["duration"], 1) if row["duration"] is not None else None,
+        "artifacts": json.loads(row["artifacts"]) if row["artifacts"] else [],
+        "artifacts_size": row["artifacts_size"],
+        "storage": row["storage"]
+    }
+
+
+def latest_backups(stack_name: Optional[str] = None) -> Dict[tuple, Dict]:
+    """Latest backup, count and total size per (stack, site) from the catalog"""
+    # SQLite returns the other columns from the row holding MAX(created)
+    rows = catalog_query(
+        """SELECT stack, site, filename, size AS latest_size, MAX(created) AS created,
+                  COUNT(*) AS count, SUM(size) AS size
+           FROM backups""" + (" WHERE stack = ?" if stack_name else "") + " GROUP BY stack, site",
+        (stack_name,) if stack_name else ()
+    )
+    return {
+        (row["stack"], row["site"]): {
+            "count": row["count"],
+            "size": row["size"],
+            "latest": {
+                "filename": row["filename"],
+                "size": row["latest_size"],
+                "created": datetime.fromtimestamp(row["created"]).isoformat()
+            }
+        }
+        for row in rows
+    }
+
+
+def find_bench_backup(source_dir: Path, output: str) -> Optional[Dict[str, Path]]:
+    """
+    The files a `bench backup` run just wrote, keyed database/files/private_files
+    
+    Taken from bench's summary lines ("Database: <path>", "Files: ..."), or else
+    the newest dump and the companion archives that share its prefix.
+    """
+    found = {}
+    for label, path in re.findall(r"^\s*(Database|Files|Private Files)\s*:\s*(\S+)", output, re.MULTILINE):
+        candidate = source_dir / Path(path).name
+        if candidate.is_file():
+            found[label.lower().replace(" ", "_")] = candidate
+    if "database" in found:
+        return found
+    
+    newest, newest_mtime = None, None
+    names = []
+    try:
+        with os.scandir(source_dir) as it:
+            for entry in it:
+                names.append(entry.name)
+                if entry.name.endswith(".sql.gz") and entry.is_file():
+                    mtime = entry.stat().st_mtime
+                    if newest_mtime is None or mtime > newest_mtime:
+                        newest, newest_mtime = Path(entry.path), mtime
+    except FileNotFoundError:
+        return None
+    if newest is None:
+        return None
+    
+    found = {"database": newest}
+    prefix = newest.name[:-len("-database.sql.gz")] if newest.name.endswith("-database.sql.gz") else None
+    for name in names:
+        match = BACKUP_ARTIFACT_RE.fullmatch(name[len(prefix):]) if prefix and name.startswith(prefix) else None
+        if match:
+            found["private_files" if match.group(1) else "files"] = source_dir / name
+    return found
+
+
+def ingest_file(src: Path, dest: Path, remove_source: bool) -> str:
+    """
+    Bring a file into the backup directory, writing its data as few times as possible
+    
+    Tries a rename (when the source is not kept) or hardlink on the same filesystem,
+    then a reflink or in-kernel copy_file_range, then a plain buffered copy.
+    Copies go through a temp name so `dest` never exists half-written.
+    Returns the method that worked.
+    """
+    try:
+        if remove_source:
+            os.rename(src, dest)
+            return "rename"
+        os.link(src, dest)
+        return "hardlink"
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+            raise
+    
+    temp = dest.with_name(f".{dest.name}.part")
+    try:
+        with open(src, "rb") as fsrc, open(temp, "wb") as fdest:
+            method = None
+            try:
+                fcntl.ioctl(fdest.fileno(), FICLONE, fsrc.fileno())
+                method = "reflink"
+            except OSError:
+                pass
+            
+            if method is None and hasattr(os, "copy_file_range"):
+                try:
+                    remaining = os.fstat(fsrc.fileno()).st_size
+                    while remaining > 0:
+                        copied = os.copy_file_range(fsrc.fileno(), fdest.fileno(), min(remaining, 1 << 30))
+                        if copied == 0:
+                            break
+                        remaining -= copied
+                    method = "copy_file_range"
+                except OSError as e:
+                    if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL):
+                        raise
+                    # Start over from the beginning with a plain copy
+                    fsrc.seek(0)
+                    fdest.seek(0)
+                    fdest.truncate()
+            
+            if method is None:
+                shutil.copyfileobj(fsrc, fdest, 1024 * 1024)
+                method = "copy"
+        
+        shutil.copystat(src, temp)
+        os.replace(temp, dest)
+    except BaseException:
+        try:
+            temp.unlink()
+        except FileNotFoundError:
+            pass
+        raise
+    
+    if remove_source:
+        src.unlink()
+    return method
+
+
+def ingest_backup(sources: Dict[str, Path], backup_dir: Path, timestamp: str,
+                  remove_source: bool) -> tuple:
+    """
+    Ingest a bench backup's dump and companion archives under one timestamp
+    Returns (dump path, companion paths, method used for the dump)
+    """
+    # Two backups within the same second get distinct names
+    stem, n = timestamp, 1
+    while (backup_dir / f"{stem}.sql.gz").exists() or (backup_dir / f"{stem}.sql.gz{MANIFEST_SUFFIX}").exists():
+        stem, n = f"{timestamp}-{n}", n + 1
+    timestamp = stem
+    
+    dest_file = backup_dir / f"{timestamp}.sql.gz"
+    method = ingest_file(sources["database"], dest_file, remove_source)
+    
+    artifacts = []
+    for kind in ("files", "private_files"):
+        if kind in sources:
+            match = BACKUP_ARTIFACT_RE.search(sources[kind].name)
+            suffix = match.group(0) if match else f"-{kind.replace('_', '-')}.tar"
+            artifact = backup_dir / f"{timestamp}{suffix}"
+            ingest_file(sources[kind], artifact, remove_source)
+            artifacts.append(artifact)
+    return dest_file, artifacts, method
+
+
+def backup_file_names(filename: str, artifacts: Optional[str]) -> List[str]:
+    """Every file a backup may consist of, given its catalog filename and artifacts"""
+    return [filename, filename + MANIFEST_SUFFIX] + (json.loads(artifacts) if artifacts else [])
+
+
+def forget_backup(stack_name: str, site_name: str, filename: str):
+    """Drop a backup's catalog row"""
+    with _catalog_lock:
+        db = get_catalog()
+        with db:
+            db.execute(
+                "DELETE FROM backups WHERE stack = ? AND site = ? AND filename = ?",
+                (stack_name, site_name, filename)
+            )
+
+
+def delete_backup(stack_name: str, site_name: str, filename: str) -> bool:
+    """
+    Remove a backup's dump (or manifest), companion archives and catalog row
+    Chunks of a deduplicated backup are only freed by the next collect_chunks().
+    """
+    backup_dir = Path(BACKUPS_CONFIG["base_path"]) / stack_name / site_name
+    rows = catalog_query(
+        "SELECT artifacts FROM backups WHERE stack = ? AND site = ? AND filename = ?",
+        (stack_name, site_name, filename)
+    )
+    
+    removed = bool(rows)
+    for name in backup_file_names(filename, rows[0]["artifacts"] if rows else None):
+        try:
+            (backup_dir / name).unlink()
+            removed = True
+        except FileNotFoundError:
+            pass
+    forget_backup(stack_name, site_name, filename)
+    return removed
+
+
+def file_checksum(path: Path) -> str:
+    """sha256 of a file"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(1024 * 1024)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Deduplicated Backup Store
+# With backups.storage: dedup, a dump is kept as a manifest listing its chunks.
+# Chunks are stored once under <base_path>/.chunks/<ab>/<sha256> (zlib), so the
+# parts of a nightly dump that did not change cost nothing. Boundaries fall at
+# line ends picked by each line's own crc32, so an edit early in a dump does
+# not shift the later boundaries. The catalog checksum of a deduplicated backup
+# is the sha256 of its uncompressed SQL.
+CHUNK_MIN = 256 * 1024
+CHUNK_MAX = 4 * 1024 * 1024
+# Past CHUNK_MIN, about one line in 64 ends a chunk
+CHUNK_BOUNDARY_MASK = 0x3f
+MANIFEST_SUFFIX = ".manifest"
+# Unreferenced chunks younger than this may belong to a backup being stored
+CHUNK_GC_GRACE = 3600
+
+# Makes "chunk exists, keep it" and "chunk unreferenced, delete it" exclusive
+_chunk_lock = threading.Lock()
+
+
+def chunk_path(digest: str) -> Path:
+    return Path(BACKUPS_CONFIG["base_path"]) / ".chunks" / digest[:2] / digest
+
+
+def iter_sql_chunks(f) -> Iterator[bytes]:
+    """Split an uncompressed dump stream into content-defined chunks"""
+    lines = []
+    size = 0
+    while True:
+        line = f.readline(CHUNK_MAX)
+        if not line:
+            break
+        lines.append(line)
+        size += len(line)
+        if size >= CHUNK_MAX or (size >= CHUNK_MIN and zlib.crc32(line) & CHUNK_BOUNDARY_MASK == 0):
+            yield b"".join(lines)
+            lines = []
+            size = 0
+    if lines:
+        yield b"".join(lines)
+
+
+def store_chunk(data: bytes) -> str:
+    """Store a chunk unless it already is; returns its hash"""
+    digest = hashlib.sha256(data).hexdigest()
+    path = chunk_path(digest)
+    with _chunk_lock:
+        if path.exists():
+            # Protects it from a concurrent collect_chunks() until our manifest exists
+            os.utime(path)
+            return digest
+    
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp = path.with_name(f".{digest}.{uuid.uuid4().hex[:8]}.tmp")
+    temp.write_bytes(zlib.compress(data, 6))
+    os.replace(temp, path)
+    return digest
+
+
+def store_dedup_backup(path: Path) -> str:
+    """
+    Replace a .sql.gz backup with a manifest of stored chunks
+    Returns the sha256 of the uncompressed SQL
+    """
+    sql_digest = hashlib.sha256()
+    chunks = []
+    with gzip.open(path, "rb") as f:
+        for data in iter_sql_chunks(f):
+            sql_digest.update(data)
+            chunks.append([store_chunk(data), len(data)])
+    
+    manifest = {
+        "version": 1,
+        "size": path.stat().st_size,
+        "sql_size": sum(length for _, length in chunks),
+        "sha256": sql_digest.hexdigest(),
+        "chunks": chunks
+    }
+    manifest_path = path.with_name(path.name + MANIFEST_SUFFIX)
+    temp = manifest_path.with_name(f".{manifest_path.name}.tmp")
+    temp.write_text(json.dumps(manifest))
+    os.replace(temp, manifest_path)
+    path.unlink()
+    return manifest["sha256"]
+
+
+def load_dedup_manifest(manifest_path: Path) -> dict:
+    """Read a manifest, raising FileNotFoundError if any of its chunks is gone"""
+    manifest = json.loads(manifest_path.read_text())
+    missing = [digest for digest, _ in manifest["chunks"] if not chunk_path(digest).is_file()]
+    if missing:
+        raise FileNotFoundError(
+            f"{len(missing)} of {len(manifest['chunks'])} chunks of {manifest_path.name} are missing"
+        )
+    return manifest
+
+
+def iter_dedup_backup(manifest: dict) -> Iterator[bytes]:
+    """Rebuild a deduplicated backup as a .sql.gz stream, one chunk at a time"""
+    # wbits=31 writes a gzip container
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for digest, _ in manifest["chunks"]:
+        data = compressor.compress(zlib.decompress(chunk_path(digest).read_bytes()))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def collect_chunks() -> dict:
+    """Delete chunks that no manifest references (mark and sweep)"""
+    base = Path(BACKUPS_CONFIG["base_path"])
+    referenced = set()
+    for manifest_path in base.glob(f"*/*/*{MANIFEST_SUFFIX}"):
+        referenced.update(digest for digest, _ in json.loads(manifest_path.read_text())["chunks"])
+    
+    cutoff = time.time() - CHUNK_GC_GRACE
+    removed = freed = kept = 0
+    store = base / ".chunks"
+    for bucket in (os.scandir(store) if store.is_dir() else []):
+        with _chunk_lock:
+            for entry in os.scandir(bucket.path):
+                if entry.name in referenced or entry.name.startswith("."):
+                    kept += 1
+                    continue
+                chunk_stat = entry.stat()
+                if chunk_stat.st_mtime >= cutoff:
+                    kept += 1
+                    continue
+                os.unlink(entry.path)
+                removed += 1
+                freed += chunk_stat.st_size
+    
+    return {"removed": removed, "freed": freed, "kept": kept, "referenced": len(referenced)}
+
+
+# Retention
+# Decided per site from the catalog, newest backup first. A backup is kept if
+# it is newer than `days`, among the newest `keep_last`, or the newest one of
+# one of the last `keep_daily` days, `keep_weekly` ISO weeks or `keep_monthly`
+# months. Everything else is pruned. Without days or keep_daily/weekly/monthly
+# nothing is pruned; keep_last is only a floor under the other rules.
+RETENTION_RULES = ("days", "keep_last", "keep_daily", "keep_weekly", "keep_monthly")
+GFS_BUCKETS = (
+    ("keep_daily", lambda created: created.date()),
+    ("keep_weekly", lambda created: tuple(created.isocalendar())[:2]),
+    ("keep_monthly", lambda created: (created.year, created.month)),
+)
+
+_prune_state = {"running": False}
+
+
+def retention_policy(stack_name: str, site_name: str) -> dict:
+    """Effective rules for a site: defaults, then `<stack>`, then `<stack>/<site>` overrides"""
+    policy = {
+        "days": BACKUPS_CONFIG.get("retention_days"),
+        "keep_last": 1,
+        "keep_daily": 0,
+        "keep_weekly": 0,
+        "keep_monthly": 0
+    }
+    overrides = RETENTION_CONFIG.get("overrides") or {}
+    for source in (RETENTION_CONFIG, overrides.get(stack_name), overrides.get(f"{stack_name}/{site_name}")):
+        for rule in RETENTION_RULES:
+            if source and source.get(rule) is not None:
+                policy[rule] = source[rule]
+    return policy
+
+
+def select_expired(backups: List[sqlite3.Row], policy: dict, now: float) -> List[sqlite3.Row]:
+    """Backups (given newest first) that no rule of the policy keeps"""
+    if not any(policy[rule] for rule in ("days", "keep_daily", "keep_weekly", "keep_monthly")):
+        return []
+    
+    keep = set(range(min(policy["keep_last"] or 0, len(backups))))
+    if policy["days"]:
+        cutoff = now - policy["days"] * 86400
+        keep.update(i for i, row in enumerate(backups) if row["created"] >= cutoff)
+    
+    for rule, bucket in GFS_BUCKETS:
+        if not policy[rule]:
+            continue
+        seen = set()
+        for i, row in enumerate(backups):
+            key = bucket(datetime.fromtimestamp(row["created"]))
+            if key in seen:
+                continue
+            if len(seen) == policy[rule]:
+                break
+            seen.add(key)
+            keep.add(i)
+    
+    return [row for i, row in enumerate(backups) if i not in keep]
+
+
+def stored_bytes(stack_name: str, site_name: str, row: sqlite3.Row) -> int:
+    """
+    Space deleting a backup frees by itself. A deduplicated backup's chunks may
+    be shared, so only its manifest counts; chunks are freed by collect_chunks().
+    """
+    if row["storage"] != "dedup":
+        return row["size"] + row["artifacts_size"]
+    manifest_path = Path(BACKUPS_CONFIG["base_path"]) / stack_name / site_name / (row["filename"] + MANIFEST_SUFFIX)
+    try:
+        return manifest_path.stat().st_size + row["artifacts_size"]
+    except FileNotFoundError:
+        return row["artifacts_size"]
+
+
+def plan_prune(stack_name: Optional[str] = None, site_name: Optional[str] = None) -> List[dict]:
+    """What the retention policies would delete, per site (from the catalog indexes)"""
+    sql = "SELECT DISTINCT stack, site FROM backups"
+    params = ()
+    if stack_name:
+        sql += " WHERE stack = ?"
+        params = (stack_name,)
+        if site_name:
+            sql += " AND site = ?"
+            params += (site_name,)
+    
+    now = time.time()
+    plans = []
+    for pair in catalog_query(sql, params):
+        policy = retention_policy(pair["stack"], pair["site"])
+        backups = catalog_query(
+            "SELECT * FROM backups WHERE stack = ? AND site = ? ORDER BY created DESC",
+            (pair["stack"], pair["site"])
+        )
+        expired = select_expired(backups, policy, now)
+        plans.append({
+            "stack": pair["stack"],
+            "site": pair["site"],
+            "policy": policy,
+            "kept": len(backups) - len(expired),
+            "expired": expired,
+            "bytes": sum(stored_bytes(pair["stack"], pair["site"], row) for row in expired),
+            "logical_bytes": sum(row["size"] + row["artifacts_size"] for row in expired)
+        })
+    return plans
+
+
+def delete_backup_batch(stack_name: str, site_name: str, rows: List[sqlite3.Row]) -> int:
+    """Delete some of a site's backups: their files, then their catalog rows at once"""
+    backup_dir = Path(BACKUPS_CONFIG["base_path"]) / stack_name / site_name
+    freed = sum(stored_bytes(stack_name, site_name, row) for row in rows)
+    for row in rows:
+        for name in backup_file_names(row["filename"], row["artifacts"]):
+            try:
+                (backup_dir / name).unlink()
+            except FileNotFoundError:
+                pass
+    
+    with _catalog_lock:
+        db = get_catalog()
+        with db:
+            db.executemany(
+                "DELETE FROM backups WHERE stack = ? AND site = ? AND filename = ?",
+                [(stack_name, site_name, row["filename"]) for row in rows]
+            )
+    return freed
+
+
+async def prune_backups(stack_name: Optional[str] = None, site_name: Optional[str] = None,
+                        dry_run: bool = False) -> dict:
+    """
+    Apply retention, deleting PRUNE_BATCH backups per step so a large backlog
+    frees space steadily without holding up the agent
+    
+    `bytes` is the space the deleted files take, plus the chunks collected
+    afterwards with dedup storage (a dry run cannot count those yet).
+    `logical_bytes` is the catalog size of the pruned backups.
+    """
+    plans = await run_in_threadpool(plan_prune, stack_name, site_name)
+    result = {
+        "dry_run": dry_run,
+        "sites": [
+            {
+                "stack": plan["stack"],
+                "site": plan["site"],
+                "policy": plan["policy"],
+                "kept": plan["kept"],
+                "prune": [backup_row(row) for row in plan["expired"]],
+                "bytes": plan["bytes"],
+                "logical_bytes": plan["logical_bytes"]
+            }
+            for plan in plans
+        ],
+        "pruned": sum(len(plan["expired"]) for plan in plans),
+        "bytes": sum(plan["bytes"] for plan in plans),
+        "logical_bytes": sum(plan["logical_bytes"] for plan in plans)
+    }
+    if dry_run or not result["pruned"]:
+        return result
+    
+    if _prune_state["running"]:
+        raise HTTPException(status_code=409, detail="A prune pass is already running")
+    _prune_state["running"] = True
+    try:
+        for plan in plans:
+            expired = plan["expired"]
+            for start in range(0, len(expired), PRUNE_BATCH):
+                await run_in_threadpool(
+                    delete_backup_batch, plan["stack"], plan["site"], expired[start:start + PRUNE_BATCH]
+                )
+        if BACKUP_STORAGE == "dedup":
+            result["chunks"] = await run_in_threadpool(collect_chunks)
+            result["bytes"] += result["chunks"]["freed"]
+    finally:
+        _prune_state["running"] = False
+    
+    logger.info(f"Pruned {result['pruned']} backups ({result['bytes']} bytes)")
+    return result
+
+
+async def prune_loop():
+    """Background task applying retention every PRUNE_INTERVAL seconds"""
+    while True:
+        await asyncio.sleep(PRUNE_INTERVAL)
+        try:
+            await prune_backups()
+        except Exception as e:
+            logger.error(f"Scheduled backup prune failed: {e}")
+
+
+# Jobs
+# Long-running actions run on a bounded pool of workers fed by a queue
+_jobs: "OrderedDict[str, Dict]" = OrderedDict()
+_job_queue: Optional[asyncio.Queue] = None
+
+
+def get_job_queue() -> asyncio.Queue:
+    """Queue feeding the job workers"""
+    global _job_queue
+    if _job_queue is None:
+        _job_queue = asyncio.Queue()
+    return _job_queue
+
+
+def _output_sink(lines: deque, on_output: Optional[Callable[[str, str], None]]) -> Callable[[str, str], None]:
+    """Wrap an output callback so lines are also kept in a transcript"""
+    def sink(stream: str, line: str):
+        lines.append(line)
+        if on_output:
+            on_output(stream, line)
+    return sink
+
+
+async def run_action(action: str, stack: str, site: Optional[str], params: Dict) -> tuple:
+    """
+    Run an action to completion
+    Returns (success, message, data)
+    """
+    try:
+        if action == "restart_stack":
+            return await restart_stack(stack, params.get("mode"), params.get("concurrency"))
+        elif action == "restart_site":
+            success, message = await restart_site(stack, site)
+        elif action == "migrate_site":
+            success, message = await migrate_site(stack, site)
+        elif action == "backup_site":
+            success, message = await backup_site(stack, site)
+        elif action == "update_stack":
+            return await update_stack(stack, params.get("mode"), params.get("concurrency"))
+        elif action == "backup_stack":
+            return await backup_stack(stack, params.get("sites"))
+        elif action == "migrate_stack":
+            return await migrate_stack(
+                stack,
+                params.get("sites"),
+                concurrency=params.get("concurrency"),
+                fail_fast=params.get("fail_fast", False)
+            )
+        elif action == "list_sites":
+            sites = await list_sites(stack)
+            return True, "Sites retrieved", {"sites": sites}
+        elif action == "get_stack_status":
+            status = await get_stack_status(stack)
+            return True, "Status retrieved", status
+        else:
+            raise HTTPException(status_code=400, detail=f"Unknown action: {action}")
+        
+        return success, message, None
+    finally:
+        if action in MUTATING_ACTIONS:
+            invalidate_stack_snapshots(stack)
+
+
+def submit_job(action: str, stack: str, site: Optional[str], params: Dict) -> Dict:
+    """Queue an action as a background job"""
+    job = {
+        "id": uuid.uuid4().hex[:12],
+        "action": action,
+        "stack": stack,
+        "site": site,
+        "params": params,
+        "state": "queued",
+        "message": "",
+        "data": None,
+        "exit_code": None,
+        "created": datetime.now(),
+        "started": None,
+        "finished": None,
+        "output": deque(maxlen=JOB_OUTPUT_LINES),
+        "done": asyncio.Event()
+    }
+    _jobs[job["id"]] = job
+    
+    # Forget the oldest finished jobs beyond the history limit
+    finished = [job_id for job_id, j in _jobs.items() if j["finished"]]
+    for job_id in finished[:max(0, len(_jobs) - JOB_HISTORY)]:
+        del _jobs[job_id]
+    
+    get_job_queue().put_nowait(job)
+    logger.info(f"Queued job {job['id']}: {action} {stack}{'/' + site if site else ''}")
+    return job
+
+
+def job_summary(job: Dict, with_output: bool = False) -> Dict:
+    """JSON-friendly view of a job"""
+    summary = {
+        "id": job["id"],
+        "action": job["action"],
+        "stack": job["stack"],
+        "site": job["site"],
+        "state": job["state"],
+        "message": job["message"],
+        "data": job["data"],
+        "exit_code": job["exit_code"],
+        "created": job["created"].isoformat(),
+        "started": job["started"].isoformat() if job["started"] else None,
+        "finished": job["finished"].isoformat() if job["finished"] else None,
+        "duration": round((job["finished"] - job["started"]).total_seconds(), 2)
+        if job["started"] and job["finished"] else None
+    }
+    if with_output:
+        summary["output"] = "\n".join(job["output"])
+    return summary
+
+
+async def job_worker():
+    """Run queued jobs one at a time"""
+    queue = get_job_queue()
+    while True:
+        job = await queue.get()
+        token = _current_job.set(job)
+        job["state"] = "running"
+        job["started"] = datetime.now()
+        try:
+            success, message, data = await run_action(job["action"], job["stack"], job["site"], job["params"])
+            job["message"] = message
+            job["data"] = data
+        except Exception as e:
+            logger.error(f"Job {job['id']} failed: {e}")
+            success = False
+            job["message"] = f"Error: {getattr(e, 'detail', None) or str(e)}"
+        finally:
+            _current_job.reset(token)
+        
+        job["state"] = "succeeded" if success else "failed"
+        if job["exit_code"] is None:
+            job["exit_code"] = 0 if success else 1
+        job["finished"] = datetime.now()
+        job["done"].set()
+        queue.task_done()
+        logger.info(f"Job {job['id']} {job['state']}: {job['message']}")
+
+
+# Batch Actions
+_batch_tasks = set()
+
+
+def check_action(action: str, site: Optional[str], params: Optional[Dict] = None):
+    """Reject actions that aren't allowed, lack their site or have bad params"""
+    if action not in SECURITY_CONFIG["allowed_actions"]:
+        raise HTTPException(status_code=403, detail=f"Action '{action}' not allowed")
+    
+    if action in SITE_ACTIONS and not site:
+        raise HTTPException(status_code=400, detail="Site name required")
+    
+    # Checked here, before a job is queued, rather than failing inside it
+    concurrency = (params or {}).get("concurrency")
+    if action in CONCURRENCY_ACTIONS and concurrency is not None and (
+        isinstance(concurrency, bool) or not isinstance(concurrency, int) or concurrency < 1
+    ):
+        raise HTTPException(status_code=400, detail="params.concurrency must be a positive integer")
+    mode = (params or {}).get("mode")
+    if action in BENCH_MODE_ACTIONS and mode is not None and mode not in ("parallel", "rolling"):
+        raise HTTPException(status_code=400, detail=f"Unknown restart mode: {mode}")
+
+
+def plan_batch(items: List[BatchActionItem]) -> List[BatchActionItem]:
+    """
+    Validate a batch: allowed actions, known stacks, unique IDs (defaulting to
+    the item's position) and `after` dependencies that exist and form no cycle
+    """
+    ids = set()
+    for index, item in enumerate(items):
+        check_action(item.action, item.site, item.params)
+        get_stack_path(item.stack)
+        item.id = item.id or str(index)
+        if item.id in ids:
+            raise HTTPException(status_code=400, detail=f"Duplicate batch item ID: {item.id}")
+        ids.add(item.id)
+    
+    for item in items:
+        unknown = [dep for dep in item.after if dep not in ids]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Item {item.id} depends on unknown items: {', '.join(unknown)}")
+    
+    # Kahn's algorithm: whatever can't be ordered is part of a cycle
+    waiting = {item.id: set(item.after) for item in items}
+    ready = [item_id for item_id, deps in waiting.items() if not deps]
+    while ready:
+        done = ready.pop()
+        del waiting[done]
+        for item_id, deps in waiting.items():
+            if done in deps:
+                deps.discard(done)
+                if not deps:
+                    ready.append(item_id)
+    if waiting:
+        raise HTTPException(status_code=400, detail=f"Dependency cycle between items: {', '.join(sorted(waiting))}")
+    
+    return items
+
+
+async def run_batch(items: List[BatchActionItem], results: asyncio.Queue, stop_on_failure: bool = False):
+    """
+    Run batch items as soon as their dependencies succeeded, up to
+    batch_concurrency at a time; job actions go through the job queue
+    
+    Items whose dependencies failed are skipped, and so is everything not yet
+    started after a failure when stop_on_failure is set. Each item's result is
+    put on `results` as it finishes, followed by None.
+    """
+    finished = {item.id: asyncio.Event() for item in items}
+    states = {}
+    limit = asyncio.Semaphore(BATCH_CONCURRENCY)
+    
+    async def run_item(item: BatchActionItem):
+        for dep in item.after:
+            await finished[dep].wait()
+        result = {"id": item.id, "action": item.action, "stack": item.stack, "site": item.site,
+                  "job_id": None, "data": None, "duration": 0}
+        failed_deps = [dep for dep in item.after if states[dep] != "succeeded"]
+        
+        if failed_deps:
+            result.update(state="skipped", message=f"Dependencies did not succeed: {', '.join(failed_deps)}")
+        else:
+            async with limit:
+                if stop_on_failure and "failed" in states.values():
+                    result.update(state="skipped", message="Skipped after an earlier failure")
+                else:
+                    started = time.monotonic()
+                    params = {k: v for k, v in (item.params or {}).items() if k != "wait"}
+                    try:
+                        if item.action in JOB_ACTIONS:
+                            job = submit_job(item.action, item.stack, item.site, params)
+                            result["job_id"] = job["id"]
+                            await job["done"].wait()
+                            success, message, data = job["state"] == "succeeded", job["message"], job["data"]
+                        else:
+                            success, message, data = await run_action(item.action, item.stack, item.site, params)
+                    except Exception as e:
+                        success, message, data = False, f"Error: {getattr(e, 'detail', None) or str(e)}", None
+                    result.update(state="succeeded" if success else "failed", message=message, data=data,
+                                  duration=round(time.monotonic() - started, 2))
+        
+        states[item.id] = result["state"]
+        finished[item.id].set()
+        results.put_nowait(result)
+    
+    try:
+        await asyncio.gather(*(run_item(item) for item in items))
+        logger.info(f"Finished batch of {len(items)} actions: "
+                    f"{sum(state == 'succeeded' for state in states.values())} succeeded")
+    finally:
+        results.put_nowait(None)
+
+
+# Lifecycle
+_background_tasks: List[asyncio.Task] = []
+
+
+@app.on_event("startup")
+async def start_site_index():
+    """Build the site index and start keeping it current"""
+    await run_in_threadpool(refresh_site_index)
+    _background_tasks.append(asyncio.create_task(poll_site_index()))
+
+
+@app.on_event("startup")
+async def start_job_workers():
+    """Start the pool of job workers"""
+    for _ in range(JOB_WORKERS):
+        _background_tasks.append(asyncio.create_task(job_worker()))
+
+
+@app.on_event("startup")
+async def start_backup_pruning():
+    """Start the scheduled retention pass"""
+    if PRUNE_INTERVAL:
+        _background_tasks.append(asyncio.create_task(prune_loop()))
+
+
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    """Cancel background tasks"""
+    for task in _background_tasks:
+        task.cancel()
+
+
+# API Endpoints
+@app.get("/")
+def root():
+    """Health check"""
+    return {"status": "healthy", "service": "FM Agent", "version": "1.0.0"}
+
+
+# Stack fields known without running anything: from config and the site index
+CHEAP_STACK_FIELDS = {"name", "path", "type", "site_names"}
+
+
+def parse_fields(fields: Optional[str]) -> Optional[List[str]]:
+    """Field list of a ?fields=a,b projection, None for everything"""
+    if not fields:
+        return None
+    return [field.strip() for field in fields.split(",") if field.strip()]
+
+
+def project(item: Dict, fields: Optional[List[str]]) -> Dict:
+    """Keep only the requested fields of a result"""
+    if fields is None or not isinstance(item, dict):
+        return item
+    return {field: item[field] for field in fields if field in item}
+
+
+def stack_config_fields(stack_name: str) -> Dict:
+    """A stack's cheap fields (see CHEAP_STACK_FIELDS)"""
+    config = STACKS_CONFIG[stack_name]
+    return {
+        "name": stack_name,
+        "path": config["path"],
+        "type": config["type"],
+        "site_names": sorted(get_stack_index(stack_name)["sites"])
+    }
+
+
+async def collect_stack_status(name: str, workers: asyncio.Semaphore) -> Dict:
+    """A stack's status within STATUS_DEADLINE, or its "timeout"/"error" placeholder"""
+    config = STACKS_CONFIG[name]
+    async with workers:
+        try:
+            return await asyncio.wait_for(get_stack_status(name), timeout=STATUS_DEADLINE)
+        except asyncio.TimeoutError:
+            logger.warning(f"Status for {name} missed the {STATUS_DEADLINE}s deadline")
+            return {
+                "name": name,
+                "path": config["path"],
+                "type": config["type"],
+                "status": "timeout",
+                "containers": [],
+                "error": f"Status not available within {STATUS_DEADLINE}s"
+            }
+        except Exception as e:
+            logger.error(f"Error getting status for {name}: {e}")
+            return {
+                "name": name,
+                "path": config["path"],
+                "type": config["type"],
+                "status": "error",
+                "error": str(e)
+            }
+
+
+@app.get("/stacks", dependencies=[Depends(verify_token)])
+async def get_stacks(fields: Optional[str] = None):
+    """Get all configured stacks
+    
+    Stacks are queried concurrently (at most STATUS_WORKERS at a time), and
+    each one gets STATUS_DEADLINE seconds before it is reported as "timeout".
+    ?fields=name,path,type,site_names answers from config and the site index
+    without querying any stack; other fields are projected from the full status.
+    """
+    fields = parse_fields(fields)
+    if fields is not None and set(fields) <= CHEAP_STACK_FIELDS:
+        return {"stacks": [project(stack_config_fields(name), fields) for name in STACKS_CONFIG]}
+    
+    workers = asyncio.Semaphore(STATUS_WORKERS)
+    stacks = await asyncio.gather(*(collect_stack_status(name, workers) for name in STACKS_CONFIG))
+    if fields is None:
+        return {"stacks": list(stacks)}
+    return {"stacks": [project({**stack_config_fields(stack["name"]), **stack}, fields) for stack in stacks]}
+
+
+@app.get("/stacks/names", dependencies=[Depends(verify_token)])
+def get_stack_names():
+    """Names, paths and types of the configured stacks (from config only)"""
+    return {"stacks": [project(stack_config_fields(name), ["name", "path", "type"]) for name in STACKS_CONFIG]}
+
+
+@app.get("/inventory", dependencies=[Depends(verify_token)])
+def get_inventory():
+    """Get the indexed stacks, benches and sites"""
+    stacks = {}
+    for name in STACKS_CONFIG:
+        index = get_stack_index(name)
+        stacks[name] = {
+            "path": STACKS_CONFIG[name]["path"],
+            "benches": {
+                bench_name: {"path": bench["path"], "sites": bench["sites"]}
+                for bench_name, bench in index["benches"].items()
+            }
+        }
+    return {
+        "stacks": stacks,
+        "updated": _site_index_updated.isoformat() if _site_index_updated else None
+    }
+
+
+@app.get("/stacks/{stack_name}", dependencies=[Depends(verify_token)])
+async def get_stack(stack_name: str, fields: Optional[str] = None):
+    """Get detailed status of a specific stack
+    
+    ?fields= projects the result; name, path, type and site_names alone are
+    answered from config and the site index.
+    """
+    fields = parse_fields(fields)
+    if fields is not None and set(fields) <= CHEAP_STACK_FIELDS:
+        get_stack_path(stack_name)
+        return project(stack_config_fields(stack_name), fields)
+    
+    try:
+        status_info = await get_stack_status(stack_name)
+        sites, age = await list_sites_snapshot(stack_name)
+        status_info["sites"] = sites
+        status_info["snapshot_age"] = max(status_info["snapshot_age"], round(age, 1))
+        if fields is None:
+            return status_info
+        return project({**stack_config_fields(stack_name), **status_info}, fields)
+    except HTTPException:
+        raise
+    except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.get("/stacks/{stack_name}/site-names", dependencies=[Depends(verify_token)])
+def get_site_names(stack_name: str):
+    """Names of a stack's sites, from the site index (no fm call)"""
+    get_stack_path(stack_name)
+    return {"stack": stack_name, "sites": sorted(get_stack_index(stack_name)["sites"])}
+
+
 @app.get("/stacks/{stack_name}/sites", dependencies=[Depends(verify_token)])
-def get_sites(stack_name: str):
-    """Get all sites in a stack"""
+async def get_sites(stack_name: str, fields: Optional[str] = None):
+    """Get all sites in a stack
+    
+    ?fields=name lists the sites in the site index without calling fm.
+    """
+    fields = parse_fields(fields)
+    if fields == ["name"]:
+        get_stack_path(stack_name)
+        return {"stack": stack_name, "sites": [{"name": site} for site in sorted(get_stack_index(stack_name)["sites"])]}
+    
     try:
-        sites = list_sites(stack_name)
-        return {"stack": stack_name, "sites": sites}
+        sites, age = await list_sites_snapshot(stack_name)
+        return {"stack": stack_name, "sites": [project(site, fields) for site in sites], "snapshot_age": round(age, 1)}
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+OVERVIEW_SECTIONS = ("status", "containers", "sites", "backups")
+
+
+@app.get("/overview", dependencies=[Depends(verify_token)])
+async def get_overview(sections: Optional[str] = None, stack: Optional[str] = None):
+    """Stacks, their sites, container state and latest backups in one response
+    
+    Every stack comes with its name, path, type and sites (name and bench,
+    from the site index). `sections` adds any of: status (fm status),
+    containers, sites (fm list status of each site), backups (latest backup,
+    count and size per site). Default is all of them; `sections=` asks for
+    none. `stack` limits the response to one stack.
+    """
+    wanted = set(OVERVIEW_SECTIONS) if sections is None else set(parse_fields(sections) or [])
+    unknown = wanted - set(OVERVIEW_SECTIONS)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown sections: {', '.join(sorted(unknown))}")
+    if stack:
+        get_stack_path(stack)
+    names = [stack] if stack else list(STACKS_CONFIG)
+    
+    workers = asyncio.Semaphore(STATUS_WORKERS)
+    backups = await run_in_threadpool(latest_backups, stack) if "backups" in wanted else {}
+    
+    async def overview(name: str) -> Dict:
+        result = project(stack_config_fields(name), ["name", "path", "type"])
+        index = get_stack_index(name)
+        sites = {site: {"name": site, "bench": bench} for site, bench in sorted(index["sites"].items())}
+        
+        if wanted & {"status", "containers"}:
+            status_info = await collect_stack_status(name, workers)
+            for key in ("status", "error", "snapshot_age"):
+                if "status" in wanted and key in status_info:
+                    result[key] = status_info[key]
+            if "containers" in wanted:
+                result["containers"] = status_info.get("containers", [])
+        
+        if "sites" in wanted:
+            try:
+                listed, age = await list_sites_snapshot(name)
+                for site in listed:
+                    site = site if isinstance(site, dict) else {"name": site}
+                    sites.setdefault(site["name"], {"name": site["name"], "bench": None}).update(site)
+                result["sites_age"] = round(age, 1)
+            except Exception as e:
+                logger.error(f"Error listing sites of {name}: {e}")
+                result["sites_error"] = getattr(e, "detail", None) or str(e)
+        
+        if "backups" in wanted:
+            for site_name, site in sites.items():
+                site["backups"] = backups.get((name, site_name))
+        
+        result["sites"] = list(sites.values())
+        return result
+    
+    stacks = await asyncio.gather(*(overview(name) for name in names))
+    return {"stacks": list(stacks), "sections": sorted(wanted), "generated": datetime.now().isoformat()}
+
+
 @app.post("/action", dependencies=[Depends(verify_token)])
-def execute_action(request: ActionRequest):
-    """Execute an allowed action"""
+async def execute_action(request: ActionRequest):
+    """Execute an allowed action
+    
+    Long-running actions are queued as background jobs and return a job ID
+    right away; pass params {"wait": true} to wait for the job's result.
+    """
     action = request.action
     stack = request.stack
     site = request.site
     
-    # Validate action
-    if action not in SECURITY_CONFIG["allowed_actions"]:
-        raise HTTPException(status_code=403, detail=f"Action '{action}' not allowed")
+    check_action(action, site, request.params)
     
     try:
-        # Execute action
-        if action == "restart_stack":
-            success, message = restart_stack(stack)
-        
-        elif action == "restart_site":
-            if not site:
-                raise HTTPException(status_code=400, detail="Site name required")
-            success, message = restart_site(stack, site)
-        
-        elif action == "migrate_site":
-            if not site:
-                raise HTTPException(status_code=400, detail="Site name required")
-            success, message = migrate_site(stack, site)
-        
-        elif action == "backup_site":
-            if not site:
-                raise HTTPException(status_code=400, detail="Site name required")
-            success, message = backup_site(stack, site)
-        
-        elif action == "update_stack":
-            success, message = update_stack(stack)
-        
-        elif action == "list_sites":
-            sites = list_sites(stack)
-            return ActionResponse(success=True, message="Sites retrieved", data={"sites": sites})
-        
-        elif action == "get_stack_status":
-            status = get_stack_status(stack)
-            return ActionResponse(success=True, message="Status retrieved", data=status)
-        
-        else:
-            raise HTTPException(status_code=400, detail=f"Unknown action: {action}")
+        if action in JOB_ACTIONS:
+            get_stack_path(stack)
+            job = submit_job(action, stack, site, request.params or {})
+            if (request.params or {}).get("wait"):
+                await job["done"].wait()
+                return ActionResponse(success=job["state"] == "succeeded", message=job["message"],
+                                      data=job_summary(job))
+            return ActionResponse(
+                success=True,
+                message=f"{action} queued as job {job['id']}",
+                data={"job_id": job["id"], "state": job["state"]}
+            )
         
-        return ActionResponse(success=success, message=message)
+        success, message, data = await run_action(action, stack, site, request.params or {})
+        return ActionResponse(success=success, message=message, data=data)
     
     except HTTPException:
         raise
@@ -630,19 +3087,74 @@ def execute_action(request: ActionRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.post("/actions/batch", dependencies=[Depends(verify_token)])
+async def execute_batch(request: BatchActionRequest):
+    """Run several actions, in parallel where their `after` dependencies allow
+    
+    The whole batch is validated before anything runs. Results are streamed as
+    NDJSON, one line per item in the order they finish, then a summary line.
+    The batch keeps running if the client goes away.
+    """
+    items = plan_batch(request.actions)
+    results: asyncio.Queue = asyncio.Queue()
+    task = asyncio.create_task(run_batch(items, results, request.stop_on_failure))
+    _batch_tasks.add(task)
+    task.add_done_callback(_batch_tasks.discard)
+    started = time.monotonic()
+    logger.info(f"Started batch of {len(items)} actions")
+    
+    async def lines():
+        counts = {"succeeded": 0, "failed": 0, "skipped": 0}
+        while True:
+            try:
+                result = await asyncio.wait_for(results.get(), timeout=15)
+            except asyncio.TimeoutError:
+                # Blank lines keep proxies from closing an idle stream
+                yield "\n"
+                continue
+            if result is None:
+                break
+            counts[result["state"]] += 1
+            yield json.dumps(result, default=str) + "\n"
+        summary = {"total": len(items), **counts, "duration": round(time.monotonic() - started, 2)}
+        yield json.dumps({"summary": summary}) + "\n"
+    
+    return StreamingResponse(
+        lines(),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@app.get("/jobs", dependencies=[Depends(verify_token)])
+def list_jobs(state: Optional[str] = None, stack: Optional[str] = None, limit: int = 50):
+    """List recent jobs, newest first"""
+    jobs = [
+        job_summary(job) for job in reversed(_jobs.values())
+        if (not state or job["state"] == state) and (not stack or job["stack"] == stack)
+    ]
+    return {"jobs": jobs[:limit]}
+
+
+@app.get("/jobs/{job_id}", dependencies=[Depends(verify_token)])
+def get_job(job_id: str):
+    """Get a job's state, timing, exit code and captured output"""
+    job = _jobs.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail=f"Job '{job_id}' not found")
+    return job_summary(job, with_output=True)
+
+
 @app.get("/backups/{stack_name}/{site_name}", dependencies=[Depends(verify_token)])
-def list_backups(stack_name: str, site_name: str):
-    """List all backups for a site"""
+def list_backups(stack_name: str, site_name: str, limit: Optional[int] = None, offset: int = 0):
+    """List all backups for a site, newest first"""
     try:
-        backup_dir = get_backup_path(stack_name, site_name)
-        
-        backups = []
-        for backup_file in sorted(backup_dir.glob("*.sql.gz"), key=lambda x: x.stat().st_mtime, reverse=True):
-            backups.append({
-                "filename": backup_file.name,
-                "size": backup_file.stat().st_size,
-                "created": datetime.fromtimestamp(backup_file.stat().st_mtime).isoformat()
-            })
+        rows = catalog_query(
+            """SELECT * FROM backups WHERE stack = ? AND site = ?
+               ORDER BY created DESC LIMIT ? OFFSET ?""",
+            (stack_name, site_name, limit if limit else -1, offset)
+        )
+        backups = [backup_row(row) for row in rows]
         
         return {"stack": stack_name, "site": site_name, "backups": backups}
     
@@ -650,26 +3162,121 @@ def list_backups(stack_name: str, site_name: str):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.get("/backups/{stack_name}", dependencies=[Depends(verify_token)])
+def stack_backups_summary(stack_name: str):
+    """Backup count, total size and latest backup per site of a stack"""
+    try:
+        sites = [{"site": site, **info} for (_, site), info in sorted(latest_backups(stack_name).items())]
+        
+        return {
+            "stack": stack_name,
+            "count": sum(site["count"] for site in sites),
+            "total_size": sum(site["size"] for site in sites),
+            "sites": sites
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/backups/catalog/rebuild", dependencies=[Depends(verify_token)])
+def rebuild_backup_catalog():
+    """Re-scan the backup directory into the catalog (after files were changed by hand)"""
+    try:
+        result = rebuild_catalog()
+        return ActionResponse(success=True, message="Backup catalog rebuilt", data=result)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/backups/gc", dependencies=[Depends(verify_token)])
+def collect_backup_chunks():
+    """Free deduplicated-store chunks no longer used by any backup"""
+    try:
+        result = collect_chunks()
+        return ActionResponse(success=True, message=f"Removed {result['removed']} unused chunks", data=result)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/retention/preview", dependencies=[Depends(verify_token)])
+async def preview_retention(stack: Optional[str] = None, site: Optional[str] = None):
+    """Show which backups the retention policies would delete, without deleting them"""
+    try:
+        return await prune_backups(stack, site, dry_run=True)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/retention/prune", dependencies=[Depends(verify_token)])
+async def run_retention(stack: Optional[str] = None, site: Optional[str] = None, dry_run: bool = False):
+    """Apply the retention policies now"""
+    try:
+        result = await prune_backups(stack, site, dry_run=dry_run)
+        return ActionResponse(
+            success=True,
+            message=f"{'Would prune' if dry_run else 'Pruned'} {result['pruned']} backups",
+            data=result
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 @app.get("/backups/{stack_name}/{site_name}/{filename}", dependencies=[Depends(verify_token)])
-def download_backup(stack_name: str, site_name: str, filename: str):
-    """Download a backup file"""
+def download_backup(request: Request, stack_name: str, site_name: str, filename: str):
+    """
+    Download a backup file
+    
+    Range requests resume stored files. Deduplicated ones are rebuilt while
+    they are sent, with no known length, so Range is ignored for them and the
+    whole file is sent (200, Accept-Ranges: none).
+    """
     try:
+        # Security: ensure filename doesn't contain path traversal
+        if ".." in filename or "/" in filename:
+            raise HTTPException(status_code=400, detail="Invalid filename")
+        
         backup_dir = get_backup_path(stack_name, site_name)
         backup_file = backup_dir / filename
+        manifest_path = backup_dir / (filename + MANIFEST_SUFFIX)
+        
+        if not backup_file.exists() and manifest_path.exists():
+            # Deduplicated backup, rebuilt while it is sent. Chunks are checked
+            # first: once streaming starts a missing one can only cut it short.
+            try:
+                manifest = load_dedup_manifest(manifest_path)
+            except FileNotFoundError as e:
+                logger.error(f"Cannot rebuild {stack_name}/{site_name}/{filename}: {e}")
+                raise HTTPException(status_code=500, detail=f"Backup is damaged: {e}")
+            return StreamingResponse(
+                iter_dedup_backup(manifest),
+                media_type="application/gzip",
+                headers={"Content-Disposition": f'attachment; filename="{filename}"', "Accept-Ranges": "none"}
+            )
         
         if not backup_file.exists():
             raise HTTPException(status_code=404, detail="Backup file not found")
         
-        # Security: ensure filename doesn't contain path traversal
+        return file_range_response(request, backup_file, "application/gzip", filename=filename)
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.delete("/backups/{stack_name}/{site_name}/{filename}", dependencies=[Depends(verify_token)])
+def remove_backup(stack_name: str, site_name: str, filename: str):
+    """Delete a backup and its companion archives"""
+    try:
         if ".." in filename or "/" in filename:
             raise HTTPException(status_code=400, detail="Invalid filename")
         
-        return FileResponse(
-            path=str(backup_file),
-            filename=filename,
-            media_type="application/gzip"
-        )
-    
+        if not delete_backup(stack_name, site_name, filename):
+            raise HTTPException(status_code=404, detail="Backup file not found")
+        
+        return ActionResponse(success=True, message=f"Backup {filename} deleted")
     except HTTPException:
         raise
     except Exception as e:
@@ -677,10 +3284,10 @@ def download_backup(stack_name: str, site_name: str, filename: str):
 
 
 @app.get("/site/{stack_name}/{site_name}/logs", dependencies=[Depends(verify_token)])
-def get_logs(stack_name: str, site_name: str, lines: int = 100):
+async def get_logs(stack_name: str, site_name: str, lines: int = 100):
     """Get site logs"""
     try:
-        success, message = get_site_logs(stack_name, site_name, lines)
+        success, message = await get_site_logs(stack_name, site_name, lines)
         return ActionResponse(success=success, message=message if not success else "", data={"logs": message if success else ""})
     except HTTPException:
         raise
@@ -688,11 +3295,72 @@ def get_logs(stack_name: str, site_name: str, lines: int = 100):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.get("/site/{stack_name}/{site_name}/logs/stream", dependencies=[Depends(verify_token)])
+async def stream_logs(stack_name: str, site_name: str, lines: int = 100):
+    """Follow site logs as Server-Sent Events (one `fm logs --follow` per viewer)"""
+    stack_path = get_stack_path(stack_name)
+    if _log_streams["active"] >= MAX_LOG_STREAMS:
+        raise HTTPException(status_code=429, detail="Too many log streams open")
+    # Take the slot now, so concurrent connects can't all pass the check
+    _log_streams["active"] += 1
+    slot = {"held": True}
+    
+    def release():
+        if slot["held"]:
+            slot["held"] = False
+            _log_streams["active"] -= 1
+    
+    async def events():
+        try:
+            async for line in stream_command(
+                ["fm", "logs", site_name, "--follow", f"--tail={lines}"],
+                cwd=stack_path,
+                heartbeat=15
+            ):
+                # Comment lines keep proxies from closing an idle stream
+                yield ": keepalive\n\n" if line is None else f"data: {line}\n\n"
+            yield "event: end\ndata: log stream ended\n\n"
+        finally:
+            release()
+    
+    # The background task also frees the slot if the stream never started
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        background=BackgroundTask(release)
+    )
+
+
 @app.get("/site/{stack_name}/{site_name}/files", dependencies=[Depends(verify_token)])
-def list_files(stack_name: str, site_name: str, path: str = ""):
-    """List files in site directory"""
+def list_files(
+    stack_name: str,
+    site_name: str,
+    path: str = "",
+    sort: str = "name",
+    order: str = "asc",
+    name: Optional[str] = None,
+    min_size: Optional[int] = None,
+    max_size: Optional[int] = None,
+    modified_after: Optional[str] = None,
+    modified_before: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = LIST_PAGE_SIZE,
+    recursive: bool = False
+):
+    """List files in site directory
+    
+    Returns one page of entries sorted by name, size or modified; `name` is a
+    glob matched case-insensitively. Pass `next_cursor` as `cursor` for the next page.
+    """
     try:
-        success, result = list_site_files(stack_name, site_name, path)
+        success, result = list_site_files(
+            stack_name, site_name, path,
+            sort=sort, order=order, name=name,
+            min_size=min_size, max_size=max_size,
+            modified_after=modified_after, modified_before=modified_before,
+            cursor=cursor, limit=limit, recursive=recursive
+        )
         if success:
             return ActionResponse(success=True, message="Files retrieved", data=result)
         else:
@@ -715,43 +3383,99 @@ def get_console_command(stack_name: str, site_name: str):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+LOG_READ_BLOCK = 64 * 1024
+LOG_READ_MAX = 4 * 1024 * 1024
+# Services whose logs /system/logs serves: systemd unit, then fallback log files
+SERVICE_LOGS = {
+    "agent": ("fm-agent", ["/var/log/fm-agent.log", "/tmp/fm-agent.log"]),
+    "dashboard": ("fm-dashboard", ["/var/log/fm-dashboard.log", "/tmp/fm-dashboard.log"])
+}
+
+
+def tail_file(path: Path, lines: int) -> tuple:
+    """
+    Read the last lines of a file by seeking backwards from the end in blocks
+    Returns (text, end_offset)
+    """
+    with open(path, "rb") as f:
+        end = f.seek(0, os.SEEK_END)
+        position = end
+        data = b""
+        # One extra newline is needed to be sure the first kept line is whole
+        while position > 0 and data.count(b"\n") <= lines and len(data) < LOG_READ_MAX:
+            size = min(LOG_READ_BLOCK, position)
+            position -= size
+            f.seek(position)
+            data = f.read(size) + data
+    
+    kept = data.splitlines(keepends=True)[-lines:] if lines > 0 else []
+    return b"".join(kept).decode(errors="replace"), end
+
+
+def read_file_since(path: Path, offset: int, lines: int) -> tuple:
+    """
+    Read what was appended to a file after a byte offset
+    
+    Only whole lines are returned, so the next offset always starts a line.
+    If the file shrank (rotated or truncated), fall back to its last lines.
+    Returns (text, next_offset, reset)
+    """
+    size = path.stat().st_size
+    if offset > size:
+        text, end = tail_file(path, lines)
+        return text, end, True
+    
+    with open(path, "rb") as f:
+        f.seek(offset)
+        data = f.read(min(size - offset, LOG_READ_MAX))
+    
+    if not data.endswith(b"\n"):
+        complete = data.rfind(b"\n") + 1
+        # A single line longer than the read limit is returned as-is
+        if complete or len(data) < LOG_READ_MAX:
+            data = data[:complete]
+    return data.decode(errors="replace"), offset + len(data), False
+
+
 @app.get("/system/logs", dependencies=[Depends(verify_token)])
-def get_agent_logs(lines: int = 100):
-    """Get agent service logs"""
+async def get_agent_logs(lines: int = 100, since: Optional[int] = None, service: str = "agent"):
+    """Get agent (or dashboard, with service=dashboard) service logs
+    
+    With a log file source, the response includes the byte offset reached;
+    pass it back as `since` to get only the lines written after it.
+    """
+    if service not in SERVICE_LOGS:
+        raise HTTPException(status_code=400, detail=f"Unknown service: {service}")
+    unit, log_files = SERVICE_LOGS[service]
     try:
-        import subprocess
-        
         # Try to get logs from journalctl (systemd service)
-        try:
-            result = subprocess.run(
-                ["journalctl", "-u", "fm-agent", "-n", str(lines), "--no-pager"],
-                capture_output=True,
-                text=True,
-                timeout=5
+        if since is None:
+            success, output, error = await run_command(
+                ["journalctl", "-u", unit, "-n", str(lines), "--no-pager"],
+                timeout=5,
+                read_only=True
             )
-            if result.returncode == 0:
+            if success:
                 return ActionResponse(
                     success=True,
-                    message="Agent logs retrieved",
-                    data={"logs": result.stdout, "source": "journalctl"}
+                    message=f"{service.capitalize()} logs retrieved",
+                    data={"logs": output, "source": "journalctl"}
                 )
-        except:
-            pass
         
         # Fallback: try to read from log file
-        log_file = Path("/var/log/fm-agent.log")
-        if not log_file.exists():
-            log_file = Path("/tmp/fm-agent.log")
-        
-        if log_file.exists():
-            with open(log_file, 'r') as f:
-                all_lines = f.readlines()
-                recent_lines = ''.join(all_lines[-lines:])
-                return ActionResponse(
-                    success=True,
-                    message="Agent logs retrieved",
-                    data={"logs": recent_lines, "source": "log_file"}
-                )
+        log_file = next((Path(path) for path in log_files if Path(path).exists()), None)
+        
+        if log_file:
+            if since is None:
+                recent_lines, offset = await run_in_threadpool(tail_file, log_file, lines)
+                reset = False
+            else:
+                recent_lines, offset, reset = await run_in_threadpool(read_file_since, log_file, since, lines)
+            return ActionResponse(
+                success=True,
+                message=f"{service.capitalize()} logs retrieved",
+                data={"logs": recent_lines, "source": "log_file", "offset": offset, "reset": reset}
+            )
         
         return ActionResponse(
             success=False,
@@ -766,18 +3490,62 @@ def get_agent_logs(lines: int = 100):
         )
 
 
+@app.get("/site/{stack_name}/{site_name}/file/raw", dependencies=[Depends(verify_token)])
+def stream_file_content(
+    request: Request,
+    stack_name: str,
+    site_name: str,
+    file_path: str,
+    mode: Optional[str] = None,
+    offset: int = 0,
+    length: int = FILE_CHUNK_SIZE
+):
+    """Stream file content
+    
+    Supports Range requests and ETag/Last-Modified validation. `mode` selects
+    a byte window instead: "head" (first `length` bytes), "tail" (last
+    `length` bytes) or "window" (`length` bytes from `offset`).
+    """
+    full_path = resolve_site_file(stack_name, site_name, file_path)
+    
+    if not full_path.exists():
+        raise HTTPException(status_code=404, detail="File not found")
+    
+    if not full_path.is_file():
+        raise HTTPException(status_code=400, detail="Path is not a file")
+    
+    if mode and length <= 0:
+        raise HTTPException(status_code=400, detail="length must be positive")
+    if mode == "window" and offset < 0:
+        raise HTTPException(status_code=400, detail="offset must not be negative")
+    
+    size = full_path.stat().st_size
+    window = None
+    if mode and size:
+        if mode == "head":
+            window = (0, min(length, size) - 1)
+        elif mode == "tail":
+            window = (max(0, size - length), size - 1)
+        elif mode == "window":
+            if offset >= size:
+                raise HTTPException(
+                    status_code=416,
+                    detail="Requested range not satisfiable",
+                    headers={"Content-Range": f"bytes */{size}"}
+                )
+            window = (offset, min(offset + length, size) - 1)
+        else:
+            raise HTTPException(status_code=400, detail=f"Unknown mode: {mode}")
+    
+    media_type = mimetypes.guess_type(full_path.name)[0] or "application/octet-stream"
+    return file_range_response(request, full_path, media_type, window=window)
+
+
 @app.get("/site/{stack_name}/{site_name}/file/read", dependencies=[Depends(verify_token)])
 def read_file_content(stack_name: str, site_name: str, file_path: str):
     """Read file content"""
     try:
-        bench_path = find_site_bench(stack_name, site_name)
-        site_dir = bench_path / "workspace" / "frappe-bench" / "sites" / site_name
-        
-        # Security: prevent path traversal
-        if ".." in file_path or file_path.startswith("/"):
-            raise HTTPException(status_code=400, detail="Invalid file path")
-        
-        full_path = site_dir / file_path
+        full_path = resolve_site_file(stack_name, site_name, file_path)
         
         if not full_path.exists():
             raise HTTPException(status_code=404, detail="File not found")
@@ -809,29 +3577,15 @@ def write_file_content(
 ):
     """Write file content"""
     try:
-        bench_path = find_site_bench(stack_name, site_name)
-        site_dir = bench_path / "workspace" / "frappe-bench" / "sites" / site_name
-        
-        # Security: prevent path traversal
-        if ".." in file_path or file_path.startswith("/"):
-            raise HTTPException(status_code=400, detail="Invalid file path")
-        
-        full_path = site_dir / file_path
-        
-        if not full_path.exists():
-            raise HTTPException(status_code=404, detail="File not found")
-        
-        if not full_path.is_file():
-            raise HTTPException(status_code=400, detail="Path is not a file")
+        full_path = resolve_site_file(stack_name, site_name, file_path)
         
-        # Write file content
-        with open(full_path, 'w') as f:
-            f.write(content)
+        # Write file content (atomically, so a failure never leaves it truncated)
+        file_stat = atomic_write(full_path, content.encode())
         
         return ActionResponse(
             success=True,
             message="File saved successfully",
-            data={"path": str(full_path)}
+            data={"path": str(full_path), "etag": file_etag(file_stat)}
         )
     except HTTPException:
         raise
@@ -839,6 +3593,71 @@ def write_file_content(
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.put("/site/{stack_name}/{site_name}/file", dependencies=[Depends(verify_token)])
+async def upload_file(
+    request: Request,
+    response: Response,
+    stack_name: str,
+    site_name: str,
+    file_path: str,
+    create: bool = False,
+    if_match: Optional[str] = Header(None)
+):
+    """Replace a site file with the request body, streamed to disk and renamed atomically
+    
+    Send the ETag the file was read with as If-Match to fail with 412 instead of
+    overwriting someone else's change. Without `create`, the file must already exist.
+    """
+    full_path = resolve_site_file(stack_name, site_name, file_path)
+    # Fail before reading the body; the check is repeated right before the rename
+    await run_in_threadpool(check_if_match, if_match, full_path, create)
+    
+    f, temp_path = await run_in_threadpool(open_temp_file, full_path)
+    try:
+        async for chunk in request.stream():
+            await run_in_threadpool(f.write, chunk)
+    except BaseException:
+        await run_in_threadpool(discard_temp_file, f, temp_path)
+        raise
+    file_stat = await run_in_threadpool(commit_temp_file, f, temp_path, full_path, if_match, create)
+    
+    etag = file_etag(file_stat)
+    response.headers["ETag"] = etag
+    return ActionResponse(
+        success=True,
+        message="File saved successfully",
+        data={"path": str(full_path), "size": file_stat.st_size, "etag": etag}
+    )
+
+
+@app.patch("/site/{stack_name}/{site_name}/file", dependencies=[Depends(verify_token)])
+def patch_file_content(
+    response: Response,
+    stack_name: str,
+    site_name: str,
+    file_path: str,
+    patch: FilePatchRequest,
+    if_match: Optional[str] = Header(None)
+):
+    """Splice small edits into a site file without sending the whole file
+    
+    Op offsets are byte offsets into the version identified by If-Match, which
+    is therefore required.
+    """
+    if not if_match:
+        raise HTTPException(status_code=428, detail="If-Match header is required")
+    full_path = resolve_site_file(stack_name, site_name, file_path)
+    file_stat = patch_file(full_path, patch.ops, if_match)
+    
+    etag = file_etag(file_stat)
+    response.headers["ETag"] = etag
+    return ActionResponse(
+        success=True,
+        message="File patched successfully",
+        data={"path": str(full_path), "size": file_stat.st_size, "etag": etag}
+    )
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(
@@ -3,18 +3,24 @@ Web Dashboard for FM/Bench Management
 Provides UI for managing stacks, sites, backups, and scheduling
 """
 import os
+import re
+import json
+import time
+import asyncio
 import yaml
 import httpx
+from collections import OrderedDict, deque
 from pathlib import Path
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Dict, Optional
 from fastapi import FastAPI, Request, Depends, HTTPException, Form, status
 from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from starlette.middleware.sessions import SessionMiddleware
+from starlette.background import BackgroundTask
 from passlib.context import CryptContext
-from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.jobstores.memory import MemoryJobStore
 from apscheduler.triggers.cron import CronTrigger
 import logging
@@ -77,31 +83,314 @@ pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 # Agent client configuration
 AGENT_URL = f"http://{AGENT_CONFIG['listen']}:{AGENT_CONFIG['port']}"
 AGENT_HEADERS = {"Authorization": f"Bearer {SECURITY_CONFIG['token']}"}
-
-# Scheduler
+AGENT_CLIENT_CONFIG = DASHBOARD_CONFIG.get("agent_client", {})
+AGENT_MAX_CONNECTIONS = AGENT_CLIENT_CONFIG.get("max_connections", 20)
+AGENT_KEEPALIVE_EXPIRY = AGENT_CLIENT_CONFIG.get("keepalive_expiry", 30)
+# Long-lived relays (log streams, downloads, file views) use their own pool, so
+# open streams cannot take the connections page views need
+AGENT_MAX_STREAMS = AGENT_CLIENT_CONFIG.get("max_streams", 10)
+
+# Timeout (seconds) and retries per agent endpoint: (name, method, path pattern,
+# timeout, retries), first match wins. Only reads get retries, and only after
+# failing to reach the agent: a timed-out call is not repeated, and all
+# attempts share the one timeout.
+AGENT_CALL_POLICIES = [
+    ("jobs", "GET", r"^/jobs", 10.0, 2),
+    ("stack_names", "GET", r"^/stacks/(names|[^/]+/site-names)$", 5.0, 2),
+    ("stacks", "GET", r"^/stacks", 30.0, 2),
+    ("overview", "GET", r"^/overview$", 30.0, 2),
+    ("system_logs", "GET", r"^/system/logs", 10.0, 1),
+    ("site_logs", "GET", r"^/site/[^/]+/[^/]+/logs$", 30.0, 1),
+    ("site_files", "GET", r"^/site/[^/]+/[^/]+/files$", 30.0, 1),
+    ("site_console", "GET", r"^/site/[^/]+/[^/]+/console$", 10.0, 1),
+    ("backups", "GET", r"^/backups/[^/]+/[^/]+$", 30.0, 1),
+    ("backup_download", "GET", r"^/backups/", 300.0, 0),
+    ("action", "POST", r"^/action$", 60.0, 0),
+]
+DEFAULT_AGENT_POLICY = ("other", "*", "", 60.0, 0)
+# Failures where the request never reached the agent
+AGENT_RETRY_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout)
+
+# Agent reads behind page views are cached: fresh for ttl seconds, then served
+# stale for up to max_stale more while one background call refreshes them
+DASHBOARD_CACHE_CONFIG = DASHBOARD_CONFIG.get("cache", {})
+AGENT_CACHE_TTL = DASHBOARD_CACHE_CONFIG.get("ttl", 10)
+AGENT_CACHE_MAX_STALE = DASHBOARD_CACHE_CONFIG.get("max_stale", 60)
+AGENT_CACHE_MAX_ENTRIES = DASHBOARD_CACHE_CONFIG.get("max_entries", 256)
+# Agent endpoints scoped to one stack: /overview?stack=<name>, /stacks/<name>/..., /backups/<name>/...
+STACK_SCOPED_READ_RE = re.compile(r"^/(?:stacks|backups)/([^/?]+)/|[?&]stack=([^&]+)")
+
+# Scheduler (runs on the app's event loop, started with the app)
 jobstores = {'default': MemoryJobStore()}
-scheduler = BackgroundScheduler(jobstores=jobstores)
-scheduler.start()
+scheduler = AsyncIOScheduler(jobstores=jobstores)
 
 
 # Helper Functions
+_agent_client: Optional[httpx.AsyncClient] = None
+_agent_stream_client: Optional[httpx.AsyncClient] = None
+_agent_stats: Dict[str, dict] = {}
+# Endpoint -> (stored at, result), oldest first
+_agent_cache: "OrderedDict[str, tuple]" = OrderedDict()
+_agent_inflight: Dict[str, asyncio.Task] = {}
+# Finished jobs whose changes were already invalidated, oldest first
+_jobs_invalidated: "OrderedDict[str, None]" = OrderedDict()
+
+
+def get_agent_client() -> httpx.AsyncClient:
+    """The dashboard's pooled keep-alive client for the agent"""
+    global _agent_client
+    if _agent_client is None or _agent_client.is_closed:
+        _agent_client = httpx.AsyncClient(
+            base_url=AGENT_URL,
+            headers=AGENT_HEADERS,
+            timeout=DEFAULT_AGENT_POLICY[3],
+            limits=httpx.Limits(
+                max_connections=AGENT_MAX_CONNECTIONS,
+                max_keepalive_connections=AGENT_MAX_CONNECTIONS,
+                keepalive_expiry=AGENT_KEEPALIVE_EXPIRY
+            )
+        )
+    return _agent_client
+
+
+def get_agent_stream_client() -> httpx.AsyncClient:
+    """Separate pooled client for responses relayed to the browser as they arrive"""
+    global _agent_stream_client
+    if _agent_stream_client is None or _agent_stream_client.is_closed:
+        _agent_stream_client = httpx.AsyncClient(
+            base_url=AGENT_URL,
+            headers=AGENT_HEADERS,
+            # No read timeout: a log stream may be quiet for minutes
+            timeout=httpx.Timeout(10.0, read=None),
+            limits=httpx.Limits(
+                max_connections=AGENT_MAX_STREAMS,
+                max_keepalive_connections=AGENT_MAX_STREAMS,
+                keepalive_expiry=AGENT_KEEPALIVE_EXPIRY
+            )
+        )
+    return _agent_stream_client
+
+
+def agent_policy(method: str, endpoint: str) -> tuple:
+    """(name, method, pattern, timeout, retries) for an agent endpoint"""
+    path = endpoint.split("?", 1)[0]
+    for policy in AGENT_CALL_POLICIES:
+        if policy[1] in ("*", method.upper()) and re.match(policy[2], path):
+            return policy
+    return DEFAULT_AGENT_POLICY
+
+
+def record_agent_call(name: str, seconds: float, ok: bool):
+    """Keep client-side latency and error counts per agent endpoint"""
+    stats = _agent_stats.setdefault(name, {
+        "calls": 0, "errors": 0, "total": 0.0, "max": 0.0, "recent": deque(maxlen=200)
+    })
+    stats["calls"] += 1
+    stats["errors"] += 0 if ok else 1
+    stats["total"] += seconds
+    stats["max"] = max(stats["max"], seconds)
+    stats["recent"].append(seconds)
+
+
+def agent_stats_summary() -> Dict[str, dict]:
+    """Latency per agent endpoint in milliseconds (percentiles over recent calls)"""
+    summary = {}
+    for name, stats in sorted(_agent_stats.items()):
+        recent = sorted(stats["recent"])
+        summary[name] = {
+            "calls": stats["calls"],
+            "errors": stats["errors"],
+            "avg_ms": round(1000 * stats["total"] / stats["calls"], 1),
+            "p50_ms": round(1000 * recent[len(recent) // 2], 1),
+            "p95_ms": round(1000 * recent[min(len(recent) - 1, int(len(recent) * 0.95))], 1),
+            "max_ms": round(1000 * stats["max"], 1)
+        }
+    return summary
+
+
+async def agent_request(method: str, endpoint: str, **kwargs) -> httpx.Response:
+    """
+    Send a request to the agent with the endpoint's timeout and retry policy,
+    recording its latency; raises httpx errors like the client does
+    """
+    name, _, _, timeout, retries = agent_policy(method, endpoint)
+    deadline = time.monotonic() + timeout
+    for attempt in range(retries + 1):
+        started = time.monotonic()
+        try:
+            response = await get_agent_client().request(
+                method, endpoint, timeout=deadline - started, **kwargs
+            )
+        except httpx.TransportError as e:
+            record_agent_call(name, time.monotonic() - started, False)
+            backoff = 0.2 * 2 ** attempt
+            if (attempt == retries or not isinstance(e, AGENT_RETRY_ERRORS)
+                    or time.monotonic() + backoff >= deadline):
+                raise
+            logger.warning(f"Agent call {method} {endpoint} failed ({e!r}), retrying")
+            await asyncio.sleep(backoff)
+            continue
+        record_agent_call(name, time.monotonic() - started, response.status_code < 500)
+        return response
+
+
 async def call_agent(method: str, endpoint: str, **kwargs):
     """Make HTTP call to agent service"""
+    if method.upper() != "GET":
+        invalidate_agent_cache()
     try:
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            response = await client.request(
-                method,
-                f"{AGENT_URL}{endpoint}",
-                headers=AGENT_HEADERS,
-                **kwargs
-            )
-            response.raise_for_status()
-            return response.json()
+        response = await agent_request(method, endpoint, **kwargs)
+        response.raise_for_status()
+        return response.json()
     except httpx.HTTPError as e:
         logger.error(f"Agent call failed: {e}")
         raise HTTPException(status_code=500, detail=f"Agent error: {str(e)}")
 
 
+def invalidate_agent_cache(stack: Optional[str] = None):
+    """
+    Drop cached agent reads (after the dashboard changed something)
+    With a stack, only reads of that stack and reads spanning every stack go.
+    """
+    def affected(endpoint: str) -> bool:
+        if stack is None:
+            return True
+        scoped = STACK_SCOPED_READ_RE.search(endpoint)
+        return scoped is None or stack in scoped.groups()
+    
+    for endpoint in [endpoint for endpoint in _agent_cache if affected(endpoint)]:
+        del _agent_cache[endpoint]
+    # Calls already in flight may carry pre-change data: forgetting them keeps
+    # them from storing it (see fetch_agent_read) or handing it to new callers
+    for endpoint in [endpoint for endpoint in _agent_inflight if affected(endpoint)]:
+        del _agent_inflight[endpoint]
+
+
+def store_agent_read(endpoint: str, result):
+    """Cache a read, dropping expired entries and then the oldest past max_entries"""
+    now = time.monotonic()
+    _agent_cache[endpoint] = (now, result)
+    _agent_cache.move_to_end(endpoint)
+    while _agent_cache:
+        oldest, (stored, _) = next(iter(_agent_cache.items()))
+        if len(_agent_cache) <= AGENT_CACHE_MAX_ENTRIES and now - stored < AGENT_CACHE_TTL + AGENT_CACHE_MAX_STALE:
+            break
+        del _agent_cache[oldest]
+
+
+async def fetch_agent_read(endpoint: str):
+    """Fetch a read once for all concurrent callers, caching the result"""
+    task = _agent_inflight.get(endpoint)
+    if task is None:
+        async def fetch():
+            try:
+                result = await call_agent("GET", endpoint)
+                if _agent_inflight.get(endpoint) is asyncio.current_task():
+                    store_agent_read(endpoint, result)
+                return result
+            finally:
+                if _agent_inflight.get(endpoint) is asyncio.current_task():
+                    del _agent_inflight[endpoint]
+        
+        task = _agent_inflight[endpoint] = asyncio.ensure_future(fetch())
+    # A caller going away must not cancel the call the others wait on
+    return await asyncio.shield(task)
+
+
+def refresh_agent_read(endpoint: str):
+    """Refresh a stale read in the background"""
+    async def refresh():
+        try:
+            await fetch_agent_read(endpoint)
+        except HTTPException as e:
+            logger.warning(f"Refreshing {endpoint} failed, serving stale data: {e.detail}")
+    
+    if endpoint not in _agent_inflight:
+        asyncio.ensure_future(refresh())
+
+
+async def cached_agent_read(endpoint: str, fresh: bool = False):
+    """
+    GET an agent endpoint through the dashboard cache (stale-while-revalidate)
+    fresh=True skips the cache, still sharing an identical call in flight.
+    """
+    entry = _agent_cache.get(endpoint)
+    if entry and not fresh:
+        age = time.monotonic() - entry[0]
+        if age < AGENT_CACHE_TTL:
+            return entry[1]
+        if age < AGENT_CACHE_TTL + AGENT_CACHE_MAX_STALE:
+            refresh_agent_read(endpoint)
+            return entry[1]
+    return await fetch_agent_read(endpoint)
+
+
+# Headers relayed between the browser and the agent for streamed responses
+FORWARDED_REQUEST_HEADERS = ("range", "if-range", "if-none-match", "if-match", "content-type")
+RELAYED_RESPONSE_HEADERS = (
+    "content-type", "content-length", "content-range", "content-disposition",
+    "accept-ranges", "etag", "last-modified", "cache-control", "x-accel-buffering"
+)
+
+
+def forwarded_headers(request: Request) -> dict:
+    """Conditional/range headers from the browser to pass on to the agent"""
+    return {k: v for k, v in request.headers.items() if k.lower() in FORWARDED_REQUEST_HEADERS}
+
+
+async def stream_agent(method: str, endpoint: str, params: Optional[dict] = None,
+                       headers: Optional[dict] = None, content=None) -> StreamingResponse:
+    """Relay an agent response to the browser as it arrives, without buffering it"""
+    if method.upper() != "GET":
+        invalidate_agent_cache()
+    client = get_agent_stream_client()
+    name = agent_policy(method, endpoint)[0]
+    started = time.monotonic()
+    try:
+        response = await client.send(
+            client.build_request(method, endpoint, params=params, headers=headers, content=content),
+            stream=True
+        )
+    except httpx.PoolTimeout:
+        record_agent_call(name, time.monotonic() - started, False)
+        raise HTTPException(status_code=503, detail="Too many open agent streams, try again shortly")
+    except httpx.HTTPError as e:
+        record_agent_call(name, time.monotonic() - started, False)
+        logger.error(f"Agent call failed: {e}")
+        raise HTTPException(status_code=502, detail=f"Agent error: {str(e)}")
+    # Time to the response headers; the body streams for as long as it takes
+    record_agent_call(name, time.monotonic() - started, response.status_code < 500)
+    
+    if response.status_code >= 400:
+        body = await response.aread()
+        await response.aclose()
+        try:
+            detail = json.loads(body).get("detail", "")
+        except ValueError:
+            detail = body.decode(errors="replace")
+        raise HTTPException(
+            status_code=response.status_code,
+            detail=f"Agent error: {detail}",
+            headers={k: v for k, v in response.headers.items() if k.lower() == "content-range"}
+        )
+    
+    async def relay():
+        try:
+            async for chunk in response.aiter_raw():
+                yield chunk
+        finally:
+            await response.aclose()
+    
+    # The background task also returns the connection to the stream pool when
+    # the browser goes away before the body is iterated
+    return StreamingResponse(
+        relay(),
+        status_code=response.status_code,
+        headers={k: v for k, v in response.headers.items() if k.lower() in RELAYED_RESPONSE_HEADERS},
+        background=BackgroundTask(response.aclose)
+    )
+
+
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     """Verify password"""
     return pwd_context.verify(plain_password, hashed_password)
@@ -135,26 +424,42 @@ async def scheduled_backup_job(stack_name: str, site_name: str):
     try:
         logger.info(f"Running scheduled backup for {stack_name}/{site_name}")
         
-        async with httpx.AsyncClient(timeout=300.0) as client:
-            response = await client.post(
-                f"{AGENT_URL}/action",
-                headers=AGENT_HEADERS,
-                json={
-                    "action": "backup_site",
-                    "stack": stack_name,
-                    "site": site_name
-                }
-            )
-            
-            if response.status_code == 200:
-                logger.info(f"Scheduled backup completed for {stack_name}/{site_name}")
-            else:
-                logger.error(f"Scheduled backup failed: {response.text}")
+        response = await agent_request(
+            "POST",
+            "/action",
+            json={
+                "action": "backup_site",
+                "stack": stack_name,
+                "site": site_name
+            }
+        )
+        
+        if response.status_code == 200:
+            logger.info(f"Scheduled backup queued for {stack_name}/{site_name}: {response.json().get('message')}")
+        else:
+            logger.error(f"Scheduled backup failed: {response.text}")
     
     except Exception as e:
         logger.error(f"Scheduled backup error: {e}")
 
 
+# Lifecycle
+@app.on_event("startup")
+async def start_scheduler():
+    """Start running scheduled backups"""
+    scheduler.start()
+
+
+@app.on_event("shutdown")
+async def stop_services():
+    """Stop the scheduler and close the agent connections"""
+    if scheduler.running:
+        scheduler.shutdown(wait=False)
+    for client in (_agent_client, _agent_stream_client):
+        if client is not None:
+            await client.aclose()
+
+
 # Routes
 @app.get("/", response_class=HTMLResponse)
 async def home(request: Request):
@@ -204,8 +509,8 @@ async def logout(request: Request):
 async def dashboard(request: Request, user: str = Depends(require_auth)):
     """Main dashboard"""
     try:
-        # Get all stacks from agent
-        stacks_data = await call_agent("GET", "/stacks")
+        # Get all stacks, with their sites and containers, from agent
+        stacks_data = await cached_agent_read("/overview?sections=status,containers")
         
         return templates.TemplateResponse(
             "dashboard.html",
@@ -232,8 +537,8 @@ async def dashboard(request: Request, user: str = Depends(require_auth)):
 async def stack_detail(request: Request, stack_name: str, user: str = Depends(require_auth)):
     """Stack detail page"""
     try:
-        # Get stack details
-        stack_data = await call_agent("GET", f"/stacks/{stack_name}")
+        # Get stack details, sites and their latest backups
+        stack_data = (await cached_agent_read(f"/overview?stack={stack_name}"))["stacks"][0]
         
         return templates.TemplateResponse(
             "stack_detail.html",
@@ -257,13 +562,19 @@ async def stack_detail(request: Request, stack_name: str, user: str = Depends(re
         )
 
 
+@app.get("/stack/{stack_name}/site-names")
+async def stack_site_names(stack_name: str, user: str = Depends(require_auth)):
+    """Site names of a stack, for dropdowns"""
+    return await cached_agent_read(f"/stacks/{stack_name}/site-names")
+
+
 @app.get("/stack/{stack_name}/refresh-sites", response_class=HTMLResponse)
 async def refresh_sites(request: Request, stack_name: str, user: str = Depends(require_auth)):
     """Refresh sites list for a stack"""
     try:
         # Get updated sites list from agent
-        stack_data = await call_agent("GET", f"/stacks/{stack_name}")
-        sites = stack_data.get("sites", [])
+        overview = await cached_agent_read(f"/overview?stack={stack_name}&sections=sites,backups", fresh=True)
+        sites = overview["stacks"][0].get("sites", [])
         
         return templates.TemplateResponse(
             "sites_list_partial.html",
@@ -279,37 +590,107 @@ async def refresh_sites(request: Request, stack_name: str, user: str = Depends(r
 
 
 @app.post("/stack/{stack_name}/restart")
-async def restart_stack(request: Request, stack_name: str, user: str = Depends(require_auth)):
-    """Restart a stack"""
+async def restart_stack(
+    request: Request,
+    stack_name: str,
+    mode: Optional[str] = Form(None),
+    user: str = Depends(require_auth)
+):
+    """Restart a stack (mode: parallel or rolling, agent default otherwise)"""
     try:
         result = await call_agent(
             "POST",
             "/action",
             json={
                 "action": "restart_stack",
-                "stack": stack_name
+                "stack": stack_name,
+                "params": {"mode": mode} if mode else {}
             }
         )
         
-        return {"success": True, "message": result.get("message", "Stack restarted")}
+        return {
+            "success": True,
+            "message": result.get("message", "Stack restarted"),
+            "job_id": (result.get("data") or {}).get("job_id")
+        }
     except Exception as e:
         return {"success": False, "message": str(e)}
 
 
 @app.post("/stack/{stack_name}/update")
-async def update_stack(request: Request, stack_name: str, user: str = Depends(require_auth)):
-    """Update a stack"""
+async def update_stack(
+    request: Request,
+    stack_name: str,
+    mode: Optional[str] = Form(None),
+    user: str = Depends(require_auth)
+):
+    """Update a stack (pull all images, then recreate containers in mode parallel or rolling)"""
     try:
         result = await call_agent(
             "POST",
             "/action",
             json={
                 "action": "update_stack",
+                "stack": stack_name,
+                "params": {"mode": mode} if mode else {}
+            }
+        )
+        
+        return {
+            "success": True,
+            "message": result.get("message", "Stack updated"),
+            "job_id": (result.get("data") or {}).get("job_id")
+        }
+    except Exception as e:
+        return {"success": False, "message": str(e)}
+
+
+@app.post("/stack/{stack_name}/backup")
+async def backup_stack(request: Request, stack_name: str, user: str = Depends(require_auth)):
+    """Backup all sites of a stack"""
+    try:
+        result = await call_agent(
+            "POST",
+            "/action",
+            json={
+                "action": "backup_stack",
                 "stack": stack_name
             }
         )
         
-        return {"success": True, "message": result.get("message", "Stack updated")}
+        return {
+            "success": True,
+            "message": result.get("message", "Stack backup started"),
+            "job_id": (result.get("data") or {}).get("job_id")
+        }
+    except Exception as e:
+        return {"success": False, "message": str(e)}
+
+
+@app.post("/stack/{stack_name}/migrate")
+async def migrate_stack(
+    request: Request,
+    stack_name: str,
+    concurrency: Optional[int] = Form(None),
+    fail_fast: bool = Form(False),
+    user: str = Depends(require_auth)
+):
+    """Migrate all sites of a stack (concurrency defaults to the agent's migrate_concurrency)"""
+    try:
+        params = {"fail_fast": fail_fast}
+        if concurrency is not None:
+            params["concurrency"] = concurrency
+        result = await call_agent(
+            "POST",
+            "/action",
+            json={"action": "migrate_stack", "stack": stack_name, "params": params}
+        )
+        
+        return {
+            "success": True,
+            "message": result.get("message", "Stack migration started"),
+            "job_id": (result.get("data") or {}).get("job_id")
+        }
     except Exception as e:
         return {"success": False, "message": str(e)}
 
@@ -333,7 +714,11 @@ async def restart_site(
             }
         )
         
-        return {"success": True, "message": result.get("message", "Site restarted")}
+        return {
+            "success": True,
+            "message": result.get("message", "Site restarted"),
+            "job_id": (result.get("data") or {}).get("job_id")
+        }
     except Exception as e:
         return {"success": False, "message": str(e)}
 
@@ -357,7 +742,11 @@ async def migrate_site(
             }
         )
         
-        return {"success": True, "message": result.get("message", "Site migrated")}
+        return {
+            "success": True,
+            "message": result.get("message", "Site migrated"),
+            "job_id": (result.get("data") or {}).get("job_id")
+        }
     except Exception as e:
         return {"success": False, "message": str(e)}
 
@@ -381,11 +770,49 @@ async def backup_site(
             }
         )
         
-        return {"success": True, "message": result.get("message", "Backup completed")}
+        return {
+            "success": True,
+            "message": result.get("message", "Backup completed"),
+            "job_id": (result.get("data") or {}).get("job_id")
+        }
     except Exception as e:
         return {"success": False, "message": str(e)}
 
 
+@app.post("/actions/batch")
+async def batch_actions(request: Request, user: str = Depends(require_auth)):
+    """Forward a batch of actions to the agent, relaying its NDJSON results as they arrive"""
+    return await stream_agent(
+        "POST",
+        "/actions/batch",
+        headers={"content-type": "application/json"},
+        content=await request.body()
+    )
+
+
+@app.get("/agent-stats")
+async def agent_call_stats(user: str = Depends(require_auth)):
+    """Client-side latency of agent calls per endpoint"""
+    return agent_stats_summary()
+
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str, user: str = Depends(require_auth)):
+    """Get the state of an agent job (polled by the UI)"""
+    try:
+        job = await call_agent("GET", f"/jobs/{job_id}")
+        if job.get("finished") and job_id not in _jobs_invalidated:
+            # What the job changed should show on the next page view; later
+            # polls of the finished job change nothing
+            invalidate_agent_cache(job.get("stack"))
+            _jobs_invalidated[job_id] = None
+            while len(_jobs_invalidated) > 1000:
+                _jobs_invalidated.popitem(last=False)
+        return job
+    except HTTPException as e:
+        return {"id": job_id, "state": "unknown", "message": e.detail}
+
+
 @app.get("/backups/{stack_name}/{site_name}", response_class=HTMLResponse)
 async def backups_page(
     request: Request,
@@ -396,7 +823,7 @@ async def backups_page(
     """Backups page for a site"""
     try:
         # Get backups list
-        backups_data = await call_agent("GET", f"/backups/{stack_name}/{site_name}")
+        backups_data = await cached_agent_read(f"/backups/{stack_name}/{site_name}")
         
         return templates.TemplateResponse(
             "backups.html",
@@ -422,30 +849,18 @@ async def backups_page(
 
 @app.get("/download/{stack_name}/{site_name}/{filename}")
 async def download_backup(
+    request: Request,
     stack_name: str,
     site_name: str,
     filename: str,
     user: str = Depends(require_auth)
 ):
-    """Download a backup file"""
-    try:
-        # Stream the file from agent
-        async with httpx.AsyncClient(timeout=300.0) as client:
-            response = await client.get(
-                f"{AGENT_URL}/backups/{stack_name}/{site_name}/{filename}",
-                headers=AGENT_HEADERS
-            )
-            response.raise_for_status()
-            
-            return StreamingResponse(
-                iter([response.content]),
-                media_type="application/gzip",
-                headers={
-                    "Content-Disposition": f"attachment; filename={filename}"
-                }
-            )
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    """Download a backup file, streamed from the agent (Range requests resume stored files)"""
+    return await stream_agent(
+        "GET",
+        f"/backups/{stack_name}/{site_name}/{filename}",
+        headers=forwarded_headers(request)
+    )
 
 
 @app.get("/site/{stack_name}/{site_name}/logs", response_class=HTMLResponse)
@@ -482,18 +897,104 @@ async def site_logs(
         )
 
 
+@app.get("/site/{stack_name}/{site_name}/logs/stream")
+async def stream_site_logs(
+    stack_name: str,
+    site_name: str,
+    lines: int = 0,
+    user: str = Depends(require_auth)
+):
+    """Relay the agent's live log stream (Server-Sent Events) to the browser"""
+    return await stream_agent(
+        "GET",
+        f"/site/{stack_name}/{site_name}/logs/stream",
+        params={"lines": lines}
+    )
+
+
+@app.get("/site/{stack_name}/{site_name}/file")
+async def site_file_content(
+    request: Request,
+    stack_name: str,
+    site_name: str,
+    file_path: str,
+    mode: Optional[str] = None,
+    offset: int = 0,
+    length: int = 65536,
+    user: str = Depends(require_auth)
+):
+    """Stream (part of) a site file from the agent, passing Range/ETag headers through"""
+    params = {"file_path": file_path}
+    if mode:
+        params.update({"mode": mode, "offset": offset, "length": length})
+    return await stream_agent(
+        "GET",
+        f"/site/{stack_name}/{site_name}/file/raw",
+        params=params,
+        headers=forwarded_headers(request)
+    )
+
+
+@app.put("/site/{stack_name}/{site_name}/file")
+async def upload_site_file(
+    request: Request,
+    stack_name: str,
+    site_name: str,
+    file_path: str,
+    create: bool = False,
+    user: str = Depends(require_auth)
+):
+    """Stream a file upload through to the agent's atomic write"""
+    return await stream_agent(
+        "PUT",
+        f"/site/{stack_name}/{site_name}/file",
+        params={"file_path": file_path, "create": create},
+        headers=forwarded_headers(request),
+        content=request.stream()
+    )
+
+
+@app.patch("/site/{stack_name}/{site_name}/file")
+async def patch_site_file(
+    request: Request,
+    stack_name: str,
+    site_name: str,
+    file_path: str,
+    user: str = Depends(require_auth)
+):
+    """Forward splice edits for a site file to the agent"""
+    return await stream_agent(
+        "PATCH",
+        f"/site/{stack_name}/{site_name}/file",
+        params={"file_path": file_path},
+        headers=forwarded_headers(request),
+        content=await request.body()
+    )
+
+
 @app.get("/site/{stack_name}/{site_name}/files", response_class=HTMLResponse)
 async def site_files(
     request: Request,
     stack_name: str,
     site_name: str,
     path: str = "",
+    sort: str = "name",
+    order: str = "asc",
+    name: Optional[str] = None,
+    cursor: Optional[str] = None,
+    recursive: bool = False,
     user: str = Depends(require_auth)
 ):
-    """Site files browser page"""
+    """Site files browser page (one page of entries at a time)"""
     try:
+        params = {"path": path, "sort": sort, "order": order, "recursive": recursive}
+        if name:
+            params["name"] = name
+        if cursor:
+            params["cursor"] = cursor
+        
         # Get files from agent
-        result = await call_agent("GET", f"/site/{stack_name}/{site_name}/files?path={path}")
+        result = await call_agent("GET", f"/site/{stack_name}/{site_name}/files", params=params)
         
         return templates.TemplateResponse(
             "site_files.html",
@@ -503,6 +1004,11 @@ async def site_files(
                 "stack_name": stack_name,
                 "site_name": site_name,
                 "current_path": path,
+                "sort": sort,
+                "order": order,
+                "name_filter": name or "",
+                "recursive": recursive,
+                "paged": bool(cursor),
                 "files_data": result.get("data", {})
             }
         )
@@ -564,34 +1070,28 @@ async def logs_viewer_page(
     try:
         from datetime import datetime
         
-        # Get all stacks
-        stacks_data = await call_agent("GET", "/stacks")
-        stacks = stacks_data.get("stacks", [])
-        
-        # Get sites for selected stack
-        sites = []
-        if stack:
-            try:
-                stack_data = await call_agent("GET", f"/stacks/{stack}")
-                sites_data = stack_data.get("sites", [])
-                # Handle both dict and string formats
-                if sites_data and isinstance(sites_data[0], dict):
-                    sites = [s["name"] for s in sites_data]
-                else:
-                    sites = sites_data
-            except:
-                sites = []
-        
-        # Get logs if both stack and site are selected
-        logs = None
-        if stack and site:
+        async def get_logs():
+            """Logs if both stack and site are selected"""
+            if not (stack and site):
+                return None
             try:
                 result = await call_agent("GET", f"/site/{stack}/{site}/logs?lines={lines}")
                 if result.get("success"):
-                    logs = result.get("data", {}).get("logs", "")
+                    return result.get("data", {}).get("logs", "")
             except Exception as e:
                 logger.error(f"Error getting logs: {e}")
-                logs = None
+            return None
+        
+        # Stacks with their site names (no status scan), alongside the logs
+        overview, logs = await asyncio.gather(cached_agent_read("/overview?sections="), get_logs())
+        stacks = overview.get("stacks", [])
+        
+        # Get sites for selected stack
+        sites = [
+            site["name"]
+            for item in stacks if item["name"] == stack
+            for site in item["sites"]
+        ]
         
         return templates.TemplateResponse(
             "logs_viewer.html",
@@ -629,44 +1129,20 @@ async def system_logs_page(
     """System logs page for Dashboard and Agent services"""
     try:
         from datetime import datetime
-        import subprocess
         
         logs = None
         source = "none"
+        offset = None
         
-        if service == "dashboard":
-            # Get dashboard logs from journalctl
-            try:
-                result = subprocess.run(
-                    ["journalctl", "-u", "fm-dashboard", "-n", str(lines), "--no-pager"],
-                    capture_output=True,
-                    text=True,
-                    timeout=5
-                )
-                if result.returncode == 0:
-                    logs = result.stdout
-                    source = "journalctl"
-            except Exception as e:
-                logger.error(f"Error getting dashboard logs: {e}")
-                # Fallback to log file
-                log_file = Path("/var/log/fm-dashboard.log")
-                if not log_file.exists():
-                    log_file = Path("/tmp/fm-dashboard.log")
-                if log_file.exists():
-                    with open(log_file, 'r') as f:
-                        all_lines = f.readlines()
-                        logs = ''.join(all_lines[-lines:])
-                        source = "log_file"
-        
-        elif service == "agent":
-            # Get agent logs via API
-            try:
-                result = await call_agent("GET", f"/system/logs?lines={lines}")
-                if result.get("success"):
-                    logs = result.get("data", {}).get("logs", "")
-                    source = result.get("data", {}).get("source", "unknown")
-            except Exception as e:
-                logger.error(f"Error getting agent logs: {e}")
+        # The agent reads both services' logs (they run on the same host)
+        try:
+            result = await call_agent("GET", "/system/logs", params={"service": service, "lines": lines})
+            if result.get("success"):
+                logs = result.get("data", {}).get("logs", "")
+                source = result.get("data", {}).get("source", "unknown")
+                offset = result.get("data", {}).get("offset")
+        except Exception as e:
+            logger.error(f"Error getting {service} logs: {e}")
         
         return templates.TemplateResponse(
             "system_logs.html",
@@ -677,6 +1153,7 @@ async def system_logs_page(
                 "lines": lines,
                 "logs": logs,
                 "source": source,
+                "offset": offset,
                 "current_time": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
             }
         )
@@ -692,6 +1169,30 @@ async def system_logs_page(
         )
 
 
+@app.get("/system-logs/tail")
+async def system_logs_tail(
+    service: str = "dashboard",
+    since: int = 0,
+    lines: int = 100,
+    user: str = Depends(require_auth)
+):
+    """Lines appended to a service's log file since a byte offset"""
+    try:
+        result = await call_agent(
+            "GET", "/system/logs", params={"service": service, "lines": lines, "since": since}
+        )
+        data = result.get("data") or {}
+        return {
+            "success": result.get("success", False),
+            "logs": data.get("logs", ""),
+            "offset": data.get("offset"),
+            "reset": data.get("reset", False)
+        }
+    except Exception as e:
+        logger.error(f"System logs tail error: {e}")
+        return {"success": False, "logs": "", "offset": since, "reset": False}
+
+
 @app.get("/scheduler", response_class=HTMLResponse)
 async def scheduler_page(request: Request, user: str = Depends(require_auth)):
     """Scheduler management page"""
@@ -707,7 +1208,7 @@ async def scheduler_page(request: Request, user: str = Depends(require_auth)):
             })
         
         # Get stacks for dropdown
-        stacks_data = await call_agent("GET", "/stacks")
+        stacks_data = await cached_agent_read("/stacks/names")
         
         return templates.TemplateResponse(
             "scheduler.html",